@@ -1,11 +1,123 @@
+import checkpoint
 import csv
 import os
+import profiling
 import random
 import wufoo_pdf
 import wufoo_entry_loader
 
+# Records which packets are finished, so interrupted runs of
+# make_reader_folders.py (or redo_reader_packets.py) can pick up where they
+# left off (see checkpoint.py).
+PACKET_JOURNAL_FILE = os.path.join('AppReading', '.reader_packets.journal')
+
+def packet_inputs(reader, packet_name, applicants, fingerprints):
+    """Hashes everything a packet is made from: who it's for and, in order,
+    each applicant's ID and app and reference (by their fingerprints, see
+    `wufoo_entry_loader.current_fingerprints`)."""
+    return checkpoint.hash_inputs(reader, packet_name, [
+        (name, id_, fingerprints['app'].get(name), fingerprints['reference'].get(name))
+        for (name, id_) in applicants
+    ])
+
+def packet_order(reader, applicants):
+    """The order `reader` reads `applicants` in: shuffled, but the same way
+    every time for the same applicants, so re-runs can tell a packet is
+    already done (and packets can be rebuilt exactly)."""
+    applicants = sorted(applicants)
+    random.Random(int(checkpoint.hash_inputs(reader, applicants), 16)).shuffle(applicants)
+    return applicants
+
+def index_entries(entries, name_field):
+    """Maps each name to the first entry with that name."""
+    index = {}
+    for entry in entries:
+        index.setdefault(entry[name_field], entry)
+    return index
+
+@profiling.timed('app_reader_folder.load_packet_entries')
+def load_packet_entries():
+    """Loads apps and references once, indexed by applicant name, for building
+    any number of application packets."""
+    apps = wufoo_entry_loader.load_apps(fields=['full_name', 'questions'])
+    references = wufoo_entry_loader.load_references(fields=['applicant_full_name', 'questions'])
+    return (index_entries(apps, 'full_name'),
+            index_entries(references, 'applicant_full_name'))
+
+class PacketFragments(object):
+    """Renders each applicant's sections of an application packet once, so
+    packets for every reader of that applicant can be stitched together from
+    the same pages.
+
+    For each applicant, we keep three fragments: the application before
+    Special Sauce, the rest of the application, and the letter of reference
+    (or a page saying it's missing).
+    """
+
+    STOP_PRE_SAUCE = 'STOP!\nGive a pre-special sauce score before looking at Special Sauce and the letter of reference.'
+    STOP_POST_REFERENCE = 'STOP!\nGive a post-reference score (including special sauce) before continuing on to the next application.'
+
+    def __init__(self, packet_entries=None):
+        if packet_entries is None:
+            packet_entries = load_packet_entries()
+        (self.apps, self.references) = packet_entries
+
+        # All fragments are rendered by one document, so fonts are loaded once.
+        self.renderer = None
+        self.stop_pre_sauce = self.render_fragment(
+            lambda pdf: pdf.add_cover_page(self.STOP_PRE_SAUCE))
+        self.stop_post_reference = self.render_fragment(
+            lambda pdf: pdf.add_cover_page(self.STOP_POST_REFERENCE))
+
+        self.applicant_fragments = {}  # (name, id) --> (pre-sauce, post-sauce, reference)
+
+    def get(self, name, id_):
+        if (name, id_) not in self.applicant_fragments:
+            self.applicant_fragments[(name, id_)] = self.render(name, id_)
+        return self.applicant_fragments[(name, id_)]
+
+    def render_fragment(self, render):
+        if self.renderer is None:
+            self.renderer = wufoo_pdf.WufooPDF()
+        return self.renderer.render_fragment(render)
+
+    @profiling.timed('PacketFragments.render')
+    def render(self, name, id_):
+        render_fragment = self.render_fragment
+        app_questions = self.apps[name]['questions']
+        pre_sauce = render_fragment(
+            lambda pdf: pdf.append(app_questions[:-3], 'Applicant #{}'.format(id_)))
+        post_sauce = render_fragment(
+            lambda pdf: pdf.append(app_questions[-3:]))
+
+        try:
+            reference_questions = self.references[name]['questions']
+            reference = render_fragment(
+                lambda pdf: pdf.append(reference_questions, 'Reference for Applicant #{}'.format(id_)))
+        except KeyError:
+            reference = render_fragment(
+                lambda pdf: pdf.add_cover_page('Reference for Applicant #{} is missing.'.format(id_)))
+
+        return (pre_sauce, post_sauce, reference)
+
+    def render_all(self, applicants):
+        """Renders fragments for all `applicants` -- (name, id) pairs -- and
+        returns them, for merging into packet fragments built elsewhere
+        (see `update`)."""
+        return dict((applicant, self.get(*applicant)) for applicant in applicants)
+
+    def update(self, applicant_fragments):
+        self.applicant_fragments.update(applicant_fragments)
+
+    def __getstate__(self):
+        # The renderer holds the fonts and every page rendered so far, none of
+        # which is needed to append fragments elsewhere.
+        state = dict(self.__dict__)
+        state['renderer'] = None
+        return state
+
 class AppReaderFolder(object):
-    def __init__(self, reader, assigned_applicants):
+    def __init__(self, reader, assigned_applicants, packet_fragments=None):
         self.reader = reader
 
         self.reader_dir = os.path.join('AppReading', reader)
@@ -14,38 +126,52 @@ class AppReaderFolder(object):
 
         self.assigned_applicants = assigned_applicants
 
-    def make_score_sheet(self):
-        with open(os.path.join(self.reader_dir, self.reader + ' Score Sheet.csv'), 'w') as f:
-            writer = csv.writer(f)
-            writer.writerow(['', 'PRE- Special Sauce Score (1-5)', 'POST- Reference Score (1-5)', 'Notes'])
-            for (_, id_) in self.assigned_applicants:
-                writer.writerow([id_])
-
-    def make_app_packet(self):
-        def get_questions(name, name_field, entries):
-            for entry in entries:
-                if entry[name_field] == name:
-                    return entry['questions']
-            raise KeyError
-
-        packet = wufoo_pdf.WufooPDF()
-        packet.add_cover_page(self.reader + '\'s Application Packet')
-
-        apps = wufoo_entry_loader.load_apps(fields=['full_name', 'questions'])
-        references = wufoo_entry_loader.load_references(fields=['applicant_full_name', 'questions'])
-
-        for (name, id_) in self.assigned_applicants:
-            app_questions = get_questions(name, 'full_name', apps)
-            packet.append(app_questions[:-3], 'Applicant #{}'.format(id_))
-            packet.add_cover_page('STOP!\nGive a pre-special sauce score before looking at Special Sauce and the letter of reference.')
-            packet.append(app_questions[-3:])
-
-            try:
-                reference_questions = get_questions(name, 'applicant_full_name', references)
-                packet.append(reference_questions, 'Reference for Applicant #{}'.format(id_))
-            except KeyError:
-                packet.add_cover_page('Reference for Applicant #{} is missing.'.format(id_))
-            packet.add_cover_page('STOP!\nGive a post-reference score (including special sauce) before continuing on to the next application.')
-
-        packet.save(os.path.join(self.reader_dir, self.reader + ' Application Packet.pdf'))
+        # Rendered sections of every applicant's packet (see PacketFragments).
+        # Loaded on demand if not shared by the caller.
+        self.packet_fragments = packet_fragments
+
+    def make_score_sheet(self, append=False, overwrite=True):
+        """Writes a score sheet with a row per assigned applicant, or, if
+        `append`, adds those rows to the existing score sheet. Unless
+        `overwrite`, an existing score sheet (which may have scores in it) is
+        left alone."""
+        path = os.path.join(self.reader_dir, self.reader + ' Score Sheet.csv')
+        if not overwrite and os.path.exists(path):
+            return
+        if append:
+            with open(path, 'a') as f:
+                csv.writer(f).writerows([id_] for (_, id_) in self.assigned_applicants)
+            return
+
+        with checkpoint.atomic_output(path) as temp_path:
+            with open(temp_path, 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(['', 'PRE- Special Sauce Score (1-5)', 'POST- Reference Score (1-5)', 'Notes'])
+                for (_, id_) in self.assigned_applicants:
+                    writer.writerow([id_])
+
+    def packet_path(self, packet_name='Application Packet'):
+        return os.path.join(self.reader_dir, self.reader + ' ' + packet_name + '.pdf')
+
+    @profiling.timed('AppReaderFolder.make_app_packet')
+    def make_app_packet(self, packet_name='Application Packet'):
+        if self.packet_fragments is None:
+            self.packet_fragments = PacketFragments()
+
+        # Packets can run to thousands of pages, so each page is written out as
+        # soon as it's appended.
+        with wufoo_pdf.streaming_pdf(self.packet_path(packet_name)) as packet:
+            add_app_packet(packet, self.reader, self.assigned_applicants, self.packet_fragments, packet_name)
+
+def add_app_packet(packet, reader, applicants, fragments, packet_name='Application Packet'):
+    """Adds `reader`'s packet -- a cover page, then each of `applicants` with
+    STOP pages between sections -- to `packet` (a WufooPDF)."""
+    packet.add_cover_page(reader + '\'s ' + packet_name)
 
+    for (name, id_) in applicants:
+        (pre_sauce, post_sauce, reference) = fragments.get(name, id_)
+        packet.append_fragment(pre_sauce)
+        packet.append_fragment(fragments.stop_pre_sauce)
+        packet.append_fragment(post_sauce)
+        packet.append_fragment(reference)
+        packet.append_fragment(fragments.stop_post_reference)
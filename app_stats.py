@@ -1,4 +1,20 @@
+"""This script counts applicants, grouped by school year and gender (or by any
+other combination of things we know about apps -- see `--help`).
+
+Examples:
+    python app_stats.py
+    python app_stats.py --by top_grade gender
+    python app_stats.py --by submission_date --format csv --output apps_by_day.csv
+"""
 from __future__ import print_function
+from collections import Counter, OrderedDict
+import argparse
+import csv
+import datetime
+import itertools
+import json
+import sys
+import profiling
 import wufoo_entry_loader
 
 def make_color(val, color):
@@ -13,39 +29,165 @@ def make_color(val, color):
     }
     return colors[color] + val + colors['reset']
 
-def count_year_by_gender(apps, year):
-    male = []
-    female = []
-    nonbinary = []
+SCHOOL_YEARS = ['Freshman', 'Sophomore', 'Junior', 'Senior', 'Co-Term']
+GENDERS = ['male', 'female', 'nonbinary']
 
-    male_identifiers = ['male', 'mal', 'cis male',
-            'cis mal', 'man', 'cis man', 'men', 'boy', 'm']
-    female_identifiers = ['female', 'femal', 'cis female',
-            'cis femal', 'woman', 'women', 'cis woman', 'girl', 'f']
+MALE_IDENTIFIERS = ['male', 'mal', 'cis male',
+        'cis mal', 'man', 'cis man', 'men', 'boy', 'm']
+FEMALE_IDENTIFIERS = ['female', 'femal', 'cis female',
+        'cis femal', 'woman', 'women', 'cis woman', 'girl', 'f']
 
-    for app in apps:
-        if app['school_year'] != year:
-            continue
+# (normalized) answer to the gender question --> gender it's counted as.
+# Anything else is counted as nonbinary.
+GENDER_TABLE = dict(
+    [(identifier, 'male') for identifier in MALE_IDENTIFIERS] +
+    [(identifier, 'female') for identifier in FEMALE_IDENTIFIERS])
 
-        if app['gender'] in male_identifiers:
-            male.append(app)
-        elif app['gender'] in female_identifiers:
-            female.append(app)
-        else:
-            nonbinary.append(app)
+def count_gender(gender):
+    return GENDER_TABLE.get(gender, 'nonbinary')
+
+def submission_date(submission_time):
+    time = wufoo_entry_loader.parse_submission_time(submission_time)
+    return 'unknown' if time == datetime.datetime.min else time.date().isoformat()
+
+def top_grade(grade_preferences):
+    """The grade an applicant ranked first (or, if answers aren't ranks, the
+    first one they picked)."""
+    picked = []
+    for (position, (grade, answer)) in enumerate(grade_preferences):
+        answer = answer.strip()
+        if answer:
+            try:
+                rank = float(answer)
+            except ValueError:
+                rank = 0
+            picked.append((rank, position, grade))
+    return min(picked)[2] if picked else 'none'
+
+class Dimension(object):
+    """Something to group apps by: the app field it's based on, a function
+    turning that field's value into a group, and (optionally) the groups to
+    always show, in order. Unless `others` is False, groups besides those are
+    shown too."""
+
+    def __init__(self, name, field, group=None, groups=None, others=True):
+        self.name = name
+        self.field = field
+        self.group = group
+        self.groups = groups
+        self.others = others
+
+DIMENSIONS = dict((dimension.name, dimension) for dimension in [
+    # Apps with any other school year aren't counted.
+    Dimension('school_year', 'school_year', groups=SCHOOL_YEARS, others=False),
+    Dimension('gender', 'gender', count_gender, GENDERS),
+    Dimension('submission_date', 'submission_time', submission_date),
+    Dimension('top_grade', 'grade_preferences', top_grade, wufoo_entry_loader.GRADE_QUESTIONS),
+])
+
+def dimension_names():
+    """Dimensions above, plus any other single-value app field (grouped by
+    exact value)."""
+    fields = [
+        field for (field, spec) in wufoo_entry_loader.APP_FIELDS.items()
+        if not isinstance(spec, wufoo_entry_loader.Questions)
+    ]
+    return sorted(set(DIMENSIONS.keys()) | set(fields))
+
+def find_dimension(name):
+    if name in DIMENSIONS:
+        return DIMENSIONS[name]
+    if name in dimension_names():
+        return Dimension(name, name)
+    raise SystemExit('Can\'t group by {} (expected one of {})'.format(name, ', '.join(dimension_names())))
 
-    return (male, female, nonbinary)
+def count_apps(apps, dimensions):
+    """Counts apps in each group (a tuple with a value for each dimension), in
+    one pass over `apps`."""
+    groupers = [(dimension.field, dimension.group) for dimension in dimensions]
+    def key(app):
+        return tuple(
+            group(app[field]) if group is not None else app[field]
+            for (field, group) in groupers)
+    return Counter(key(app) for app in apps)
+
+def iter_counts(counts, dimensions):
+    """Yields (groups, count) in order. Groups that nobody's in are included
+    only when every dimension has groups to always show (so, e.g., every school
+    year shows up)."""
+    orders = []
+    for (i, dimension) in enumerate(dimensions):
+        groups = list(dimension.groups or [])
+        observed = set(key[i] for key in counts)
+        orders.append(groups + (sorted(observed - set(groups)) if dimension.others else []))
+
+    if all(dimension.groups for dimension in dimensions):
+        for groups in itertools.product(*orders):
+            yield (groups, counts.get(groups, 0))
+    else:
+        positions = [dict((group, i) for (i, group) in enumerate(order)) for order in orders]
+        shown = [
+            key for key in counts
+            if all(group in position for (position, group) in zip(positions, key))
+        ]
+        for groups in sorted(shown, key=lambda key: [position[group] for (position, group) in zip(positions, key)]):
+            yield (groups, counts[groups])
+
+def write_text(counts, dimensions, out, colors):
+    color = make_color if colors else lambda val, color: val
+    rows = iter_counts(counts, dimensions)
+    for (group, subgroups) in itertools.groupby(rows, key=lambda row: row[0][0]):
+        subgroups = list(subgroups)
+        total = sum(count for (_, count) in subgroups)
+        print('{}: {}'.format(color(group, 'bold'), color('{} applicants'.format(total), 'italic')), file=out)
+        if len(dimensions) > 1:
+            for (groups, count) in subgroups:
+                print('  {} of those are {}'.format(count, ', '.join(groups[1:])), file=out)
+            print(file=out)
+
+def write_csv(counts, dimensions, out):
+    writer = csv.writer(out)
+    writer.writerow([dimension.name for dimension in dimensions] + ['applicants'])
+    for (groups, count) in iter_counts(counts, dimensions):
+        writer.writerow(list(groups) + [count])
+
+def write_json(counts, dimensions, out):
+    names = [dimension.name for dimension in dimensions]
+    rows = [
+        OrderedDict(list(zip(names, groups)) + [('applicants', count)])
+        for (groups, count) in iter_counts(counts, dimensions)
+    ]
+    json.dump(rows, out, indent=2)
+    out.write('\n')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Count applicants by school year and gender, or anything else.')
+    parser.add_argument('--by', nargs='+', default=['school_year', 'gender'], metavar='DIMENSION',
+            help='what to group applicants by (default: school_year gender), any of: ' +
+                 ', '.join(dimension_names()))
+    parser.add_argument('--format', choices=['text', 'csv', 'json'], default='text',
+            help='output format (default: text)')
+    parser.add_argument('--output', default=None,
+            help='file to write counts to (default: print them)')
+    return parser.parse_args()
 
 def main():
-    apps = wufoo_entry_loader.load_apps(fields=['full_name', 'school_year', 'gender'])
-    for year in ['Freshman', 'Sophomore', 'Junior', 'Senior', 'Co-Term']:
-        male, female, nonbinary = count_year_by_gender(apps, year)
-        total = len(male) + len(female) + len(nonbinary)
-        print('{}: {}'.format(make_color(year, 'bold'), make_color('{} applicants'.format(total), 'italic')))
-        print('  {} of those are male'.format(len(male)))
-        print('  {} of those are female'.format(len(female)))
-        print('  {} of those are nonbinary'.format(len(nonbinary)))
-        print()
+    args = parse_args()
+    dimensions = [find_dimension(name) for name in args.by]
+    fields = sorted(set(dimension.field for dimension in dimensions))
+    counts = count_apps(wufoo_entry_loader.scan_apps(fields=fields), dimensions)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        if args.format == 'csv':
+            write_csv(counts, dimensions, out)
+        elif args.format == 'json':
+            write_json(counts, dimensions, out)
+        else:
+            write_text(counts, dimensions, out, colors=out is sys.stdout)
+    finally:
+        if out is not sys.stdout:
+            out.close()
 
 if __name__ == '__main__':
-    main()
+    profiling.run(main)
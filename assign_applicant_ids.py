@@ -1,24 +1,48 @@
 """This script writes out a CSV file mapping applicant names to applicant IDs.
 
-Note: The order is randomized each time, so only run this once!
+Note: The order is randomized each time, so only run this once! To give IDs to
+applicants who applied late, use `add_applicant_ids` (see `ingest_late_entries.py`).
 """
 from __future__ import print_function
 import csv
 import os
 import random
+import profiling
 import wufoo_entry_loader
 
+APPLICANT_IDS_FILE = os.path.join('AppReading', 'applicant_ids.csv')
+
+def load_applicant_ids():
+    with open(APPLICANT_IDS_FILE) as f:
+        reader = csv.reader(f)
+        return dict((row[0], row[1]) for row in reader)  # name --> id
+
+def add_applicant_ids(names):
+    """Gives IDs to any of `names` without one, after all existing IDs (so
+    existing applicants keep theirs), and returns every applicant's ID."""
+    applicant_ids = load_applicant_ids()
+    new_names = sorted(set(name for name in names if name not in applicant_ids))
+    random.shuffle(new_names)
+
+    next_id = max([int(id_) for id_ in applicant_ids.values()] + [-1]) + 1
+    with open(APPLICANT_IDS_FILE, 'a') as f:
+        writer = csv.writer(f)
+        for (i, name) in enumerate(new_names):
+            applicant_ids[name] = str(next_id + i)
+            writer.writerow([name, applicant_ids[name]])
+
+    return applicant_ids
+
 def main():
-    apps = wufoo_entry_loader.load_apps(['full_name'])
-    random.shuffle(apps)
+    names = [app['full_name'] for app in wufoo_entry_loader.iter_apps(['full_name'])]
+    random.shuffle(names)
 
     # Save applicant IDs.
     # Index in list is their ID.
-    with open(os.path.join('AppReading', 'applicant_ids.csv'), 'w') as f:
+    with open(APPLICANT_IDS_FILE, 'w') as f:
         writer = csv.writer(f)
-        for i, app in enumerate(apps):
-            writer.writerow([app['full_name'], str(i)])
+        for i, name in enumerate(names):
+            writer.writerow([name, str(i)])
 
 if __name__ == '__main__':
-    main()
-
+    profiling.run(main)
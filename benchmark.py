@@ -0,0 +1,209 @@
+"""This script times each stage of the pipeline on fake exports (see
+`make_synthetic_exports.py`), so we can tell whether changes make things
+faster or slower.
+
+Everything runs in a temporary directory, so your real `AppReading` directory
+is never touched. For each stage, we record wall time, CPU time (of this
+process and, separately, of its worker processes) and peak memory (of this
+process, and only for stages without workers) and save the results as JSON in
+`benchmark_results/`, to compare against later runs.
+
+Example: `python benchmark.py --applicants 10000 --pdf-limit 100`
+"""
+from __future__ import print_function
+from collections import OrderedDict
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import assign_applicant_ids
+import cross_reference
+import make_individual_pdfs
+import make_reader_folders
+import make_synthetic_exports
+import profiling
+import wufoo_entry_loader
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+process_time = getattr(time, 'process_time', None) or time.clock
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmark_results')
+
+@contextlib.contextmanager
+def quiet():
+    """Hides the (very chatty) output of the stages being timed."""
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+def worker_process_time():
+    """CPU time used by finished worker processes (pools are joined at the
+    end of each stage), or None where we can't tell."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def time_stage(results, name, fn, trace_memory, uses_workers=False):
+    # Worker processes forked while tracing would trace every allocation too,
+    # making them many times slower, so stages with workers aren't traced.
+    trace_memory = trace_memory and tracemalloc is not None and not uses_workers
+    if trace_memory:
+        tracemalloc.start()
+    start_wall = time.time()
+    start_cpu = process_time()
+    start_worker_cpu = worker_process_time()
+    with quiet():
+        items = fn()
+    cpu = process_time() - start_cpu
+    worker_cpu = None if start_worker_cpu is None else worker_process_time() - start_worker_cpu
+    wall = time.time() - start_wall
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    results[name] = OrderedDict([
+        ('wall_seconds', round(wall, 4)),
+        ('cpu_seconds', round(cpu, 4)),
+        ('worker_cpu_seconds', None if worker_cpu is None else round(worker_cpu, 4)),
+        ('peak_memory_bytes', peak_memory),
+        ('items', items),
+    ])
+    print('{:<28} {:>9.3f}s wall {:>9.3f}s cpu {:>10} worker cpu {:>10} peak{}'.format(
+        name, wall, cpu,
+        '{:.3f}s'.format(worker_cpu) if worker_cpu is not None else '?',
+        '{:.1f}MB'.format(peak_memory / 1e6) if peak_memory is not None else '?',
+        '  ({} items)'.format(items) if items is not None else ''))
+
+def clear_entry_caches():
+    wufoo_entry_loader.loaded_snapshots.clear()
+    for file_name in ('apps.csv', 'references.csv'):
+        snapshot = wufoo_entry_loader.cache_file_name(os.path.join('AppReading', file_name))
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
+
+def run_benchmarks(args):
+    results = OrderedDict()
+    state = {}
+
+    def load_entries():
+        apps = wufoo_entry_loader.load_apps()
+        references = wufoo_entry_loader.load_references()
+        return len(apps) + len(references)
+
+    def load_warm():
+        wufoo_entry_loader.loaded_snapshots.clear()
+        return load_entries()
+
+    def assign_ids():
+        assign_applicant_ids.main()
+        state['applicants'] = make_reader_folders.load_applicants()
+        return len(state['applicants'])
+
+    def assign_readers():
+        conflicts_of_interest = make_reader_folders.load_conflicts_of_interest()
+        state['reader2apps'] = make_reader_folders.make_app_assignments(
+            state['applicants'], conflicts_of_interest, args.seed)[0]
+        return sum(len(apps) for apps in state['reader2apps'].values())
+
+    def render_pdfs():
+        for directory in ('apps', 'references'):
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+        names = set(sorted(state['applicants'].keys())[:args.pdf_limit])
+        make_individual_pdfs.make_app_pdfs(state['applicants'], True, args.workers, names)
+        make_individual_pdfs.make_reference_pdfs(state['applicants'], True, args.workers, names)
+        return len(os.listdir('apps')) + len(os.listdir('references'))
+
+    def build_packets():
+        readers = sorted(state['reader2apps'].keys())[:args.packet_readers]
+        make_reader_folders.make_reader_folders(
+            dict((reader, state['reader2apps'][reader]) for reader in readers), args.workers)
+        return len(readers)
+
+    clear_entry_caches()
+    time_stage(results, 'load (parse CSV)', load_entries, args.trace_memory)
+    time_stage(results, 'load (from snapshot)', load_warm, args.trace_memory)
+    time_stage(results, 'cross_reference', cross_reference.main, args.trace_memory)
+    time_stage(results, 'assign_applicant_ids', assign_ids, args.trace_memory)
+    time_stage(results, 'make_app_assignments', assign_readers, args.trace_memory)
+    if args.pdf_limit:
+        time_stage(results, 'render individual pdfs', render_pdfs, args.trace_memory, uses_workers=True)
+    if args.packet_readers:
+        time_stage(results, 'build reader packets', build_packets, args.trace_memory, uses_workers=True)
+    return results
+
+def make_parser():
+    parser = make_synthetic_exports.make_parser()
+    parser.description = 'Time each stage of the pipeline on fake exports.'
+    parser.add_argument('--pdf-limit', type=int, default=200,
+            help='make individual PDFs for this many applicants (default: 200; 0 to skip)')
+    parser.add_argument('--packet-readers', type=int, default=3,
+            help='build packets for this many readers (default: 3; 0 to skip)')
+    parser.add_argument('--workers', type=int, default=None,
+            help='number of processes making PDFs (default: one per CPU)')
+    parser.add_argument('--no-memory', dest='trace_memory', action='store_false',
+            help='don\'t measure peak memory (tracing memory slows the stages without workers down)')
+    parser.add_argument('--output', default=None,
+            help='where to save results (default: a new file in benchmark_results/)')
+    return parser
+
+def main():
+    args = make_parser().parse_args()
+    random.seed(args.seed)
+
+    workspace = tempfile.mkdtemp(prefix='kesem-benchmark-')
+    cwd = os.getcwd()
+    try:
+        # The scripts expect to run from a directory with fonts/ and AppReading/.
+        shutil.copytree(os.path.join(REPO_DIR, 'fonts'), os.path.join(workspace, 'fonts'))
+        os.chdir(workspace)
+        print('Making fake exports for {} applicants...'.format(args.applicants))
+        make_synthetic_exports.make_synthetic_exports(args)
+        stages = run_benchmarks(args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace)
+
+    parameters = dict((key, value) for (key, value) in vars(args).items() if key != 'output')
+    results = OrderedDict([
+        ('timestamp', datetime.datetime.now().isoformat()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('parameters', parameters),
+        ('stages', stages),
+    ])
+
+    output = args.output
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.mkdir(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, 'benchmark-{}.json'.format(
+            datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Saved results to {}'.format(output))
+
+if __name__ == '__main__':
+    profiling.run(main)
@@ -0,0 +1,97 @@
+"""Helper library for scripts that make lots of files, so they can pick up
+where they left off after a crash (or Ctrl-C) instead of starting over.
+
+A journal records each file a script finished making, along with a hash of
+everything the file was made from (its "inputs"). Before making a file,
+scripts check `is_done`: if the journal says the file was made from the same
+inputs, and the file hasn't changed since, it's skipped.
+
+Files should be written with `atomic_output`, so a crash never leaves a
+half-written file behind that looks finished.
+"""
+import contextlib
+import hashlib
+import json
+import os
+
+# os.rename can't replace existing files on Windows (and python 2 has no
+# os.replace).
+replace = getattr(os, 'replace', os.rename)
+
+def hash_inputs(*inputs):
+    """Hashes the things a file is made from (strings, numbers and lists or
+    tuples of them)."""
+    return hashlib.sha1(repr(inputs).encode('utf-8')).hexdigest()
+
+def hash_file(file_name):
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """Yields a temporary file name to write to, which is renamed to `path`
+    once writing succeeds (and deleted if it fails)."""
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        yield temp_path
+        replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+class Journal(object):
+    """Finished files and what they were made from, saved (one JSON record
+    per line) to `path` as each file is finished."""
+
+    def __init__(self, path):
+        self.path = path
+        self.finished = {}  # output file --> latest record
+        lines = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # the last line, if we crashed while writing it
+                    self.finished[record['output']] = record
+
+        # Re-running a script adds a record per file, so drop stale ones now
+        # and then.
+        if lines > 2 * len(self.finished) + 100:
+            with atomic_output(path) as temp_path:
+                with open(temp_path, 'w') as f:
+                    for record in self.finished.values():
+                        f.write(json.dumps(record) + '\n')
+
+    def is_done(self, output, inputs):
+        """Whether `output` was already made from `inputs` (see `hash_inputs`)
+        and is still just as we made it."""
+        record = self.finished.get(output)
+        if record is None or record['inputs'] != inputs:
+            return False
+        try:
+            stat = os.stat(output)
+        except OSError:
+            return False
+        if stat.st_size != record['size']:
+            return False
+        return stat.st_mtime == record['mtime'] or hash_file(output) == record['hash']
+
+    def record(self, output, inputs):
+        """Records that `output` was just made from `inputs`."""
+        stat = os.stat(output)
+        record = {
+            'output': output,
+            'inputs': inputs,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'hash': hash_file(output),
+        }
+        self.finished[output] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
@@ -1,5 +1,7 @@
 from __future__ import print_function
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+import re
+import profiling
 import wufoo_entry_loader
 
 colors = {
@@ -14,33 +16,148 @@ colors = {
 def make_color(val, color):
     return colors[color] + val + colors['reset']
 
-def join_tables(R, S, key):
-    join = []
-    for r in R:
-        for s in S:
-            if key(r, s):
-                join.append((r, s))
-    return join
-
-def unique_tuples(join, key):
-    unique = defaultdict(list)
-    for (r, s) in join:
-        if r not in unique[key(r)]:
-            unique[key(r)].append(r)
-        if s not in unique[key(r)]:
-            unique[key(r)].append(s)
-    return unique
-
-def partial_match(app, reference):
-    return app['first_name'] == reference['applicant_first_name'] or \
-            app['last_name'] == reference['applicant_last_name']
+def build_index(entries, field):
+    """Maps each value of `field` to the positions of the entries holding it."""
+    index = defaultdict(list)
+    for (i, entry) in enumerate(entries):
+        index[entry[field]].append(i)
+    return index
+
+@profiling.timed('cross_reference.find_duplicates')
+def find_duplicates(entries, field):
+    """Groups entries sharing a value of `field`, keeping groups with at least
+    two distinct entries (in order of first appearance)."""
+    duplicates = OrderedDict()
+    index = build_index(entries, field)
+    for (value, positions) in sorted(index.items(), key=lambda item: item[1][0]):
+        group = []
+        for i in positions:
+            if entries[i] not in group:
+                group.append(entries[i])
+        if len(group) > 1:
+            duplicates[value] = group
+    return duplicates
+
+# Names this similar (0 to 1, see `name_similarity`) count as partial matches.
+# Exact first or last name matches always score at least this.
+MIN_SIMILARITY = 0.5
+
+def name_parts(name):
+    """Splits hyphenated and multi-word names, e.g. 'mary-kate' --> ['mary', 'kate']."""
+    return [part for part in re.split(r"[\s\-.']+", name) if part] or [name]
+
+def ngrams(word, n=3):
+    padded = '^' + word + '$'
+    return set(padded[i:i + n] for i in range(max(1, len(padded) - n + 1)))
+
+SOUNDEX_CODES = dict(
+    (letter, str(code))
+    for (code, letters) in enumerate(['aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r'])
+    for letter in letters
+)
+
+def soundex(word):
+    """Phonetic code, so e.g. 'smith' and 'smyth' sound alike."""
+    word = ''.join(c for c in word if c in SOUNDEX_CODES)
+    if not word:
+        return ''
+    code = word[0]
+    previous = SOUNDEX_CODES[word[0]]
+    for c in word[1:]:
+        digit = SOUNDEX_CODES[c]
+        if digit != '0' and digit != previous:
+            code += digit
+        if c not in 'hw':
+            previous = digit
+    return (code + '000')[:4]
+
+def part_similarity(a, b, memo=None):
+    """How similar two name parts are, from 0 to 1. `memo`, if given, is a
+    dict remembering pairs already compared."""
+    if a == b:
+        return 1.0
+    if memo is not None and (a, b) in memo:
+        return memo[(a, b)]
+    if len(a) >= 3 and len(b) >= 3 and (a.startswith(b) or b.startswith(a)):
+        similarity = 0.9  # nicknames, e.g. 'alex' and 'alexander'
+    else:
+        (a_grams, b_grams) = (ngrams(a), ngrams(b))
+        similarity = 2.0 * len(a_grams & b_grams) / (len(a_grams) + len(b_grams))
+        if soundex(a) == soundex(b):
+            similarity = max(similarity, 0.6)
+    if memo is not None:
+        memo[(a, b)] = similarity
+    return similarity
+
+def name_similarity(a, b, memo=None):
+    """How similar two first (or last) names are, from 0 to 1. Hyphenated
+    names are as similar as their most similar parts. See `part_similarity`
+    for `memo`."""
+    return max(part_similarity(a_part, b_part, memo) for a_part in name_parts(a) for b_part in name_parts(b))
+
+def block_keys(name):
+    keys = set()
+    for part in name_parts(name):
+        keys.update(ngrams(part))
+        keys.add('#' + soundex(part))
+    return keys
+
+class FuzzyNameIndex(object):
+    """Finds entries whose names are similar to a given name (typos,
+    nicknames, hyphenated names, swapped first and last names).
+
+    Entries are indexed by blocks: the character trigrams and soundex codes of
+    their first and last names. Only entries sharing at least two blocks with
+    a name are compared against it, instead of every entry.
+    """
+
+    def __init__(self, entries, first_name_field, last_name_field):
+        self.entries = entries
+        self.names = [(entry[first_name_field], entry[last_name_field]) for entry in entries]
+        # The same name parts are compared over and over (e.g., common first
+        # names), so we remember their similarity for as long as this index
+        # lives -- not longer, since a process may check many sets of exports
+        # (see kesem.py).
+        self.part_similarities = {}
+        self.blocks = defaultdict(list)
+        for (i, (first_name, last_name)) in enumerate(self.names):
+            for key in block_keys(first_name) | block_keys(last_name):
+                self.blocks[key].append(i)
+
+    def similarity(self, i, first_name, last_name):
+        (other_first_name, other_last_name) = self.names[i]
+        memo = self.part_similarities
+        return max(
+            (name_similarity(first_name, other_first_name, memo) + name_similarity(last_name, other_last_name, memo)) / 2,
+            (name_similarity(first_name, other_last_name, memo) + name_similarity(last_name, other_first_name, memo)) / 2,
+        )
+
+    def matches(self, first_name, last_name, min_similarity=MIN_SIMILARITY):
+        """Returns (similarity, entry) pairs, most similar first."""
+        shared_blocks = defaultdict(int)
+        for key in block_keys(first_name) | block_keys(last_name):
+            for i in self.blocks.get(key, []):
+                shared_blocks[i] += 1
+
+        scored = []
+        for (i, count) in shared_blocks.items():
+            if count >= 2:
+                similarity = self.similarity(i, first_name, last_name)
+                if similarity >= min_similarity:
+                    scored.append((similarity, i))
+        scored.sort(key=lambda pair: (-pair[0], pair[1]))
+        return [(similarity, self.entries[i]) for (similarity, i) in scored]
 
 def main():
+    """Prints every issue found, and returns the number of issues that have to
+    be fixed before running other scripts (i.e., all but missing references
+    and applications)."""
     print(make_color('This script should output no issues (besides missing references) ' +\
             'before you continue running other scripts.', 'red'))
     print()
 
-    # submission_time allows us to differentiate entries
+    # Resubmissions (same email, or same reference and applicant) were already
+    # dropped by the loader, and submission_time differentiates the rest.
     apps = wufoo_entry_loader.load_apps(fields=[
         'first_name', 'last_name', 'full_name', 'email', 'submission_time'])
     references = wufoo_entry_loader.load_references(fields=[
@@ -48,11 +165,26 @@ def main():
         'reference_first_name', 'reference_last_name', 'reference_full_name',
         'submission_time'])
 
+    ### RESUBMISSIONS ###
+
+    # The loader already keeps just the latest of these, so they aren't issues.
+    superseded_apps = wufoo_entry_loader.load_superseded_apps(fields=['full_name', 'email', 'submission_time'])
+    for app in superseded_apps:
+        print('Ignoring an earlier application from {} ({}, submitted {}) in favor of their latest one.'.format(
+            make_color(app['full_name'], 'blue'), app['email'], app['submission_time']))
+
+    superseded_references = wufoo_entry_loader.load_superseded_references(fields=[
+        'applicant_full_name', 'reference_full_name', 'submission_time'])
+    for reference in superseded_references:
+        print('Ignoring an earlier letter of reference for {} from {} (submitted {}) in favor of their latest one.'.format(
+            make_color(reference['applicant_full_name'], 'blue'), reference['reference_full_name'],
+            reference['submission_time']))
+
+    if superseded_apps or superseded_references: print()
+
     ### DUPLICATE APPS ###
 
-    duplicate_apps = unique_tuples(
-        join_tables(apps, apps, lambda a1, a2: a1['full_name'] == a2['full_name'] and a1 != a2),
-        key=lambda app: app['full_name'])
+    duplicate_apps = find_duplicates(apps, 'full_name')
 
     for (name, matches) in duplicate_apps.items():
         print('Applicant {} submitted {} written applications.'.format(
@@ -64,10 +196,7 @@ def main():
 
     ### DUPLICATE REFERENCES ###
 
-    duplicate_references = unique_tuples(
-        join_tables(references, references,
-            lambda r1, r2: r1['applicant_full_name'] == r2['applicant_full_name'] and r1 != r2),
-        key=lambda reference: reference['applicant_full_name'])
+    duplicate_references = find_duplicates(references, 'applicant_full_name')
 
     for (name, duplicates) in duplicate_references.items():
         print('Applicant {} has multiple letters of reference from {} and {}.'.format(
@@ -79,19 +208,20 @@ def main():
     if len(duplicate_references) > 0: print()
 
     # This removes all matched apps and references, so we don't have to deal with them below.
-    have_references = join_tables(apps, references, lambda a, r: a['full_name'] == r['applicant_full_name'])
-    for (a, r) in have_references:
-        if a in apps:
-            apps.remove(a)
-        if r in references:
-            references.remove(r)
+    app_names = build_index(apps, 'full_name')
+    reference_names = build_index(references, 'applicant_full_name')
+    apps = [a for a in apps if a['full_name'] not in reference_names]
+    references = [r for r in references if r['applicant_full_name'] not in app_names]
+
+    app_index = FuzzyNameIndex(apps, 'first_name', 'last_name')
+    reference_index = FuzzyNameIndex(references, 'applicant_first_name', 'applicant_last_name')
 
     ### REFERENCES WITHOUT APPS ###
 
     found = False
     for reference in references:
-        matching_apps = join_tables([reference], apps,
-                lambda r, a: partial_match(a, r))  # we don't want to include partial matches since those printed below
+        matching_apps = app_index.matches(reference['applicant_first_name'],
+                reference['applicant_last_name'])  # we don't want to include partial matches since those printed below
         if len(matching_apps) == 0:
             found = True
             print('We have a letter of reference for {} (written by {}) but no matching application.'.format(
@@ -104,9 +234,12 @@ def main():
 
     ### APPS WITHOUT REFERENCES ###
 
-    for app in apps:
-        matching_references = join_tables([app], references,
-                lambda a, r: partial_match(a, r))
+    app_matches = [
+        (app, reference_index.matches(app['first_name'], app['last_name']))
+        for app in apps
+    ]
+
+    for (app, matching_references) in app_matches:
         if len(matching_references) == 0:
             found = True
             print('We have an application for {} ({}) but no letter of reference.'.format(
@@ -120,21 +253,25 @@ def main():
     
     ### PARTIAL REFERENCE MATCHES ###
 
-    for app in apps:
-        matches = join_tables([app], references,
-                lambda a, r: partial_match(a, r))
+    # Most likely matches first.
+    app_matches.sort(key=lambda pair: -pair[1][0][0] if pair[1] else 0)
+    for (app, matches) in app_matches:
         if len(matches) > 0:
             if not found:
                 print(make_color('We can\'t find matching letters of reference for applicants below, but do have references for people\n' +\
-                    'with partially matching names (first or last name matches).', 'bold'))
+                    'with similar names (most similar first).', 'bold'))
                 found = True
             print('{} ({}): {}'.format(
                 make_color(app['full_name'], 'green'),
                 app['email'],
-                ', '.join('{} (written by {})'.format(
-                    make_color(match[1]['applicant_full_name'], 'green'), match[1]['reference_full_name']) for match in matches)
+                ', '.join('{} (written by {}, {:.0%} similar)'.format(
+                    make_color(match['applicant_full_name'], 'green'), match['reference_full_name'], similarity)
+                    for (similarity, match) in matches)
             ))
 
+    partial_matches = sum(1 for (_, matches) in app_matches if len(matches) > 0)
+    return len(duplicate_apps) + len(duplicate_references) + partial_matches
+
 if __name__ == '__main__':
-    main()
+    profiling.run(main)
 
@@ -0,0 +1,117 @@
+"""This script processes applications and letters of reference that came in (or
+changed) after reader folders were made, without redoing everything else.
+
+Late applicants get new IDs and readers (existing IDs and assignments are left
+alone), each affected reader gets a "Late Additions" packet and new score sheet
+rows, and individual PDFs are made for just the late entries.
+"""
+from __future__ import print_function
+from collections import defaultdict
+import argparse
+import os
+import re
+import app_reader_folder
+import assign_applicant_ids
+import make_individual_pdfs
+import make_reader_folders
+import profiling
+import wufoo_entry_loader
+
+def next_batch_number():
+    """Late additions packets are numbered, so later batches don't overwrite
+    earlier ones."""
+    batch_numbers = [0]
+    for reader in next(os.walk('AppReading'))[1]:
+        for file_name in os.listdir(os.path.join('AppReading', reader)):
+            match = re.search(r' Late Additions (\d+)\.pdf$', file_name)
+            if match:
+                batch_numbers.append(int(match.group(1)))
+    return max(batch_numbers) + 1
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Process late applications and references.')
+    parser.add_argument('--workers', type=int, default=None,
+            help='number of processes making individual PDFs (default: one per CPU)')
+    parser.add_argument('--seed', type=int, default=None,
+            help='seed for assigning readers, so assignments can be reproduced')
+    return parser.parse_args()
+
+def run(workers=None, seed=None, anonymous=None):
+    """Processes late entries. `anonymous` says whether individual PDFs are
+    anonymous (we ask if it's None). Returns False if they couldn't be
+    processed."""
+    processed = wufoo_entry_loader.load_processed_fingerprints()
+    if processed is None:
+        print('There\'s no record of which entries were already processed. Run `make_reader_folders.py` first.')
+        return False
+
+    current = wufoo_entry_loader.current_fingerprints()
+    (late_apps, late_references) = wufoo_entry_loader.find_late_entries(processed, current)
+    if not late_apps and not late_references:
+        print('No new or changed applications or references.')
+        return True
+
+    print('Found {} new or changed applications and {} new or changed letters of reference.'.format(
+        len(late_apps), len(late_references)))
+
+    ### APPLICANT IDS AND READERS ###
+
+    applicant_ids = assign_applicant_ids.add_applicant_ids(late_apps)
+    reader2apps = make_reader_folders.load_app_assignments(applicant_ids)
+    assigned = set(applicant for applicants in reader2apps.values() for applicant in applicants)
+    new_applicants = dict(
+        (name, applicant_ids[name]) for name in late_apps
+        if (name, applicant_ids[name]) not in assigned
+    )
+
+    conflicts_of_interest = make_reader_folders.load_conflicts_of_interest()
+    initial_loads = dict((reader, len(applicants)) for (reader, applicants) in reader2apps.items())
+    try:
+        new_reader2apps, new_app2readers = make_reader_folders.make_app_assignments(
+            new_applicants, conflicts_of_interest, seed, initial_loads)
+    except make_reader_folders.InfeasibleAssignmentError as e:
+        print('Couldn\'t assign readers to every late applicant:')
+        print(e)
+        return False
+    make_reader_folders.append_app_assignments(new_app2readers)
+
+    ### READER FOLDERS ###
+
+    # Readers get their new applicants, plus any of their existing applicants
+    # whose app or reference changed.
+    changed = set(late_apps) | set(late_references)
+    additions = defaultdict(list)
+    for (reader, applicants) in reader2apps.items():
+        additions[reader] = [applicant for applicant in applicants if applicant[0] in changed]
+    for reader in sorted(new_reader2apps.keys()):
+        applicants = app_reader_folder.packet_order(reader, new_reader2apps[reader])
+        additions[reader].extend(applicants)
+        app_reader_folder.AppReaderFolder(reader, applicants).make_score_sheet(append=True)
+
+    packet_name = 'Late Additions {}'.format(next_batch_number())
+    fragments = app_reader_folder.PacketFragments()
+    for reader in sorted(additions.keys()):
+        if additions[reader]:
+            app_reader_folder.AppReaderFolder(reader, additions[reader], fragments).make_app_packet(packet_name)
+            print('Made {} for {} ({} applicants)'.format(packet_name, reader, len(additions[reader])))
+
+    ### INDIVIDUAL PDFS ###
+
+    if os.path.isdir('apps') or os.path.isdir('references'):
+        if anonymous is None:
+            anonymous = raw_input('Would you like application PDFs to be anonymous (Y or N)? ')
+            anonymous = anonymous.strip().lower() == 'y'
+        if os.path.isdir('apps'):
+            make_individual_pdfs.make_app_pdfs(applicant_ids, anonymous, workers, set(late_apps))
+        if os.path.isdir('references'):
+            make_individual_pdfs.make_reference_pdfs(applicant_ids, anonymous, workers, set(late_references))
+
+    wufoo_entry_loader.save_processed_fingerprints(current)
+    return True
+
+def main():
+    args = parse_args()
+    run(args.workers, args.seed)
+
+if __name__ == '__main__':
+    profiling.run(main)
@@ -0,0 +1,161 @@
+"""One command for every script in this repo.
+
+    python kesem.py cross_reference
+    python kesem.py app_stats --by gender
+
+is the same as `python cross_reference.py` and so on (including `--profile`).
+Each script is imported only when its command runs, so quick checks like
+`cross_reference` and `app_stats` never load fpdf or fonts.
+
+Run `python kesem.py` with no command for a shell that runs commands one after
+another in the same process. Apps and references stay loaded between commands
+(and are reloaded only when the exports change), so fixing an export and
+running `cross_reference` again is nearly instant.
+
+With `--timing`, we print how long starting up, importing the command's script
+and running it took. The shell always does.
+"""
+from __future__ import print_function
+import time
+
+STARTED = time.time()  # before anything else is imported
+
+from collections import OrderedDict
+import cmd
+import importlib
+import shlex
+import sys
+import traceback
+import profiling
+import wufoo_entry_loader
+
+# command (and script) --> what it does
+COMMANDS = OrderedDict([
+    ('cross_reference', 'check apps and references for missing or mismatched entries'),
+    ('app_stats', 'count applicants by school year, gender and so on'),
+    ('search_answers', 'search app and reference answers'),
+    ('assign_applicant_ids', 'give every applicant an anonymous ID'),
+    ('make_applicant_list', 'list applicants with their IDs'),
+    ('make_conflicts_of_interest_spreadsheet', 'make the spreadsheet readers mark conflicts in'),
+    ('make_reader_folders', 'assign readers and make their folders and packets'),
+    ('make_individual_pdfs', 'make a PDF for each app and reference'),
+    ('ingest_late_entries', 'add late apps and references to reader folders'),
+    ('redo_reader_packets', 'make some readers\' packets again'),
+    ('rank_applicants', 'rank applicants from readers\' score sheets'),
+    ('packet_server', 'serve PDFs, making each one when it\'s first opened'),
+    ('make_camper_files', 'make a PDF for each camper'),
+    ('pipeline', 'run every out-of-date step'),
+    ('make_synthetic_exports', 'make fake exports for testing'),
+    ('benchmark', 'time the scripts on fake exports'),
+])
+
+def format_ms(seconds):
+    return '{:.0f} ms'.format(seconds * 1000)
+
+def run_command(name, args):
+    """Runs a command's script as if it was run with `args`. Returns (import
+    time, run time) in seconds."""
+    start = time.time()
+    module = importlib.import_module(name)
+    imported = time.time()
+
+    argv = sys.argv
+    sys.argv = ['kesem.py ' + name] + args  # so `--help` shows the right usage
+    try:
+        profiling.run(module.main)
+    finally:
+        sys.argv = argv
+    return (imported - start, time.time() - imported)
+
+class Shell(cmd.Cmd):
+    intro = 'Type a command (with options, e.g. "app_stats --by gender"), "help" or "exit".'
+    prompt = 'kesem> '
+
+    def onecmd(self, line):
+        (name, _, _) = line.strip().partition(' ')
+        if name not in COMMANDS:
+            return cmd.Cmd.onecmd(self, line)
+        try:
+            args = shlex.split(line)
+        except ValueError as e:
+            print(e)
+            return
+
+        try:
+            (import_time, run_time) = run_command(args[0], args[1:])
+        except SystemExit as e:  # e.g., from `--help` or a bad option
+            if e.code is not None and not isinstance(e.code, int):
+                print(e.code)
+            return
+        except KeyboardInterrupt:
+            print()
+            return
+        except Exception:
+            traceback.print_exc()
+            return
+        print('({} to import, {} to run)'.format(format_ms(import_time), format_ms(run_time)))
+
+    def default(self, line):
+        print('Unknown command: {} (type "help" for a list)'.format(line.split()[0]))
+
+    def completenames(self, text, *ignored):
+        return [name for name in list(COMMANDS) + ['help', 'exit'] if name.startswith(text)]
+
+    def do_help(self, line):
+        if line.strip() in COMMANDS:
+            self.onecmd(line.strip() + ' --help')
+            return
+        print_commands()
+
+    def do_exit(self, line):
+        return True
+
+    do_quit = do_exit
+
+    def do_EOF(self, line):
+        print()
+        return True
+
+    def emptyline(self):
+        pass
+
+def print_commands():
+    print('Commands (add --help to one for its options):')
+    for (name, description) in COMMANDS.items():
+        print('  {:<40} {}'.format(name, description))
+
+def shell():
+    wufoo_entry_loader.keep_entries_loaded = True
+    print('Ready in {}.'.format(format_ms(time.time() - STARTED)))
+    try:
+        Shell().cmdloop()
+    except KeyboardInterrupt:
+        print()
+
+def main():
+    args = sys.argv[1:]
+    timing = '--timing' in args
+    if timing:
+        args.remove('--timing')
+
+    if not args:
+        shell()
+        return
+    if args[0] in ('-h', '--help', 'help'):
+        print('usage: kesem.py [--timing] [command [options]]')
+        print()
+        print_commands()
+        print()
+        print('With no command, starts a shell for running commands one after another.')
+        return
+    if args[0] not in COMMANDS:
+        raise SystemExit('Unknown command: {} (run "python kesem.py --help" for a list)'.format(args[0]))
+
+    startup_time = time.time() - STARTED
+    (import_time, run_time) = run_command(args[0], args[1:])
+    if timing:
+        print('{} to start, {} to import {}, {} to run'.format(
+            format_ms(startup_time), format_ms(import_time), args[0], format_ms(run_time)), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 from __future__ import print_function
 import csv
 import os
+import profiling
 import wufoo_entry_loader
 
 def load_applicant_ids():
@@ -13,7 +14,7 @@ def load_applicant_ids():
 
 def main():
     applicant_ids = load_applicant_ids()
-    apps = wufoo_entry_loader.load_apps(fields=['full_name', 'school_year', 'gender'])
+    apps = wufoo_entry_loader.iter_apps(fields=['full_name', 'school_year', 'gender'])
 
     with open(os.path.join('AppReading', 'applicant_list.csv'), 'w') as f:
         writer = csv.writer(f)
@@ -22,5 +23,5 @@ def main():
             writer.writerow([applicant_ids[app['full_name']], app['full_name'], app['school_year'], app['gender']])
 
 if __name__ == '__main__':
-    main()
+    profiling.run(main)
 
@@ -1,26 +1,77 @@
+"""This script makes a PDF for each camper in `camper_info.csv`, in a folder
+for their unit under `camper_files/`. With `--combined`, it also makes one PDF
+per unit (`camper_files/<unit>.pdf`) with every camper in that unit.
+"""
 from __future__ import print_function
+from collections import OrderedDict
+import argparse
 import csv
 import os
-from wufoo_pdf import WufooPDF
+import make_individual_pdfs
+import profiling
+import wufoo_pdf
 
-def make_app_pdfs():
+# Records which camper files are finished, so an interrupted run can pick up
+# where it left off (see checkpoint.py).
+JOURNAL_FILE = os.path.join('camper_files', '.make_camper_files.journal')
+
+def load_campers():
+    """Reads `camper_info.csv` in one pass, returning its headers and each
+    unit's campers (as rows, in file order)."""
+    units = OrderedDict()
     with open('camper_info.csv', 'r') as csvfile:
         camperreader = csv.reader(csvfile)
         headers = next(camperreader)
-        for row in camperreader: 
+        for row in camperreader:
+            if row:
+                units.setdefault(row[1], []).append(row)
+    return (headers, units)
+
+def camper_pdf_jobs(headers, units):
+    for (unit, rows) in units.items():
+        for row in rows:
             camper_name = row[0]
-            pdf = WufooPDF()
-            pdf.append(zip(headers[1:], row[1:]), camper_name)
-            unit_dir = os.path.join('camper_files/', row[1])
-            if not os.path.isdir(unit_dir):
-                os.mkdir(unit_dir)
-            pdf.save(os.path.join(unit_dir, camper_name) + '.pdf')
+            path = os.path.join('camper_files', unit, camper_name) + '.pdf'
+            yield (camper_name, path, list(zip(headers[1:], row[1:])))
+
+def unit_pdf_jobs(headers, units):
+    for (unit, rows) in units.items():
+        campers = [(row[0], list(zip(headers[1:], row[1:]))) for row in rows]
+        yield (unit, os.path.join('camper_files', unit) + '.pdf', campers)
+
+def make_unit_pdf(job):
+    """Makes one PDF with every camper in a unit, written out page by page."""
+    (unit, path, campers, _) = job
+    with wufoo_pdf.streaming_pdf(path) as pdf:
+        pdf.add_cover_page(unit)
+        for (camper_name, questions) in campers:
+            pdf.append(questions, camper_name)
+
+def make_camper_files(workers=None, combined=False):
+    (headers, units) = load_campers()
+    for unit in units:
+        unit_dir = os.path.join('camper_files', unit)
+        if not os.path.isdir(unit_dir):
+            os.mkdir(unit_dir)
+
+    make_individual_pdfs.make_pdfs(camper_pdf_jobs(headers, units), 'camper', workers, JOURNAL_FILE)
+    if combined:
+        make_individual_pdfs.make_pdfs(unit_pdf_jobs(headers, units), 'unit', workers, JOURNAL_FILE,
+                                       make=make_unit_pdf, chunk_size=1)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Make a PDF for each camper, in a folder for their unit.')
+    parser.add_argument('--workers', type=int, default=None,
+            help='number of processes making PDFs (default: one per CPU)')
+    parser.add_argument('--combined', action='store_true',
+            help='also make one PDF per unit with all of its campers')
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     if not os.path.isdir('camper_files'):
         os.mkdir('camper_files')
-    make_app_pdfs()
+    make_camper_files(args.workers, args.combined)
 
 if __name__ == '__main__':
-    main()
-
+    profiling.run(main)
@@ -1,6 +1,7 @@
 from __future__ import print_function
 import csv
 import os
+import profiling
 
 def load_applicants():
     with open(os.path.join('AppReading', 'applicant_ids.csv')) as f:
@@ -9,17 +10,18 @@ def load_applicants():
 
 def main():
     applicants = load_applicants()
-    
-    with open(os.path.join('AppReading', 'conflicts_of_interest.csv'), 'w') as f:
-        writer = csv.writer(f)
 
-        readers = []
-        while True:
-            reader = raw_input('Enter application reader\'s name (or nothing to continue): ')
-            if not reader:
-                break
-            readers.append(reader)
+    # Ask for readers before opening the spreadsheet, so quitting here leaves
+    # an existing one as it was.
+    readers = []
+    while True:
+        reader = raw_input('Enter application reader\'s name (or nothing to continue): ')
+        if not reader:
+            break
+        readers.append(reader)
 
+    with open(os.path.join('AppReading', 'conflicts_of_interest.csv'), 'w') as f:
+        writer = csv.writer(f)
         writer.writerow([''] + readers)
 
         for applicant in applicants:
@@ -30,5 +32,5 @@ def main():
     print('Open this file in a Google Sheet, have readers mark those apps they should not read, then run `assign_app_readers.py`')
 
 if __name__ == '__main__':
-    main()
+    profiling.run(main)
 
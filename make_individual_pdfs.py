@@ -1,14 +1,29 @@
 from __future__ import print_function
+import argparse
 import csv
 import fpdf
+import functools
+import multiprocessing
 import os
 import random
 import re
 import sys
-from collections import OrderedDict
+import time
+from collections import OrderedDict, deque
+import checkpoint
+import profiling
 import wufoo_entry_loader
+import wufoo_pdf
 from wufoo_pdf import WufooPDF
 
+# Number of PDFs handed to a worker at a time. Small enough that progress
+# updates stay frequent, large enough that dispatch overhead doesn't matter.
+CHUNK_SIZE = 10
+
+# Records which PDFs are finished, so an interrupted run can pick up where it
+# left off (see checkpoint.py).
+JOURNAL_FILE = os.path.join('AppReading', '.make_individual_pdfs.journal')
+
 def load_applicant_ids():
     with open(os.path.join('AppReading', 'applicant_ids.csv')) as f:
         reader = csv.reader(f)
@@ -17,13 +32,114 @@ def load_applicant_ids():
             for app_id in reader
         }
 
-def make_app_pdfs(applicant_ids, anonymous):
-    apps = wufoo_entry_loader.load_apps(fields=['full_name', 'questions'])
-    for i, app in enumerate(apps):
-        if i != 0 and i % 10 == 0:
-            print('Made {}/{} Application PDFs'.format(i, len(apps)))
+def make_pdf(job):
+    (pdf_title, path, questions, _) = job
+    pdf = WufooPDF()
+    pdf.append(questions, pdf_title)
+    pdf.save(path)
+
+def make_pdf_chunk(jobs, make=make_pdf):
+    """Makes a PDF for each job (with `make`), returning (path, inputs, error)
+    triples. A job that fails (e.g., on text fpdf can't encode) is reported
+    instead of stopping the whole run."""
+    results = []
+    for job in jobs:
+        try:
+            make(job)
+            results.append((job[1], job[3], None))
+        except Exception as e:
+            results.append((job[1], job[3], '{}: {}'.format(type(e).__name__, e)))
+    profiling.flush()
+    return results
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def imap_bounded(pool, fn, items, window):
+    """Like `pool.imap`, but only reads `items` as workers catch up (keeping at
+    most `window` of them queued), where `pool.imap` reads all of them up front."""
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(fn, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def make_pdfs(jobs, description, workers=None, journal_file=JOURNAL_FILE, make=make_pdf,
+        chunk_size=CHUNK_SIZE):
+    """Makes PDFs for `jobs` -- (title, path, questions) tuples -- in a pool of
+    `workers` processes (one per CPU by default). Each worker loads fonts once
+    and reuses them for every PDF it makes.
+
+    Other scripts can make other kinds of PDFs with `make`, a top-level
+    function taking a (title, path, contents, inputs) job, and record them in
+    their own `journal_file`. Big PDFs should be handed to workers in smaller
+    chunks (`chunk_size`).
+
+    `jobs` can be a generator: only a few chunks of jobs per worker are read at
+    a time, so memory use doesn't grow with the number of PDFs.
+
+    PDFs already made from the same title and questions (by an earlier,
+    possibly interrupted, run) are skipped.
+    """
+    start = time.time()
+    journal = checkpoint.Journal(journal_file)
+    skipped = [0]
+
+    def unfinished_jobs():
+        for (pdf_title, path, questions) in jobs:
+            inputs = checkpoint.hash_inputs(pdf_title, questions)
+            if journal.is_done(path, inputs):
+                skipped[0] += 1
+            else:
+                yield (pdf_title, path, questions, inputs)
+
+    chunks = chunked(unfinished_jobs(), chunk_size)
+    workers = workers or multiprocessing.cpu_count()
+    make_chunk = functools.partial(make_pdf_chunk, make=make)
+
+    if workers == 1:
+        wufoo_pdf.preload_fonts()
+        finished = (make_chunk(chunk) for chunk in chunks)
+    else:
+        pool = multiprocessing.Pool(workers, wufoo_pdf.preload_fonts)
+        finished = imap_bounded(pool, make_chunk, chunks, workers * 2)
 
+    made = 0
+    failed = 0
+    for results in finished:
+        for (path, inputs, error) in results:
+            if error is None:
+                journal.record(path, inputs)
+                made += 1
+            else:
+                failed += 1
+                print('Could not make {}, skipping it ({})'.format(path, error))
+        print('Made {} {} PDFs so far'.format(made, description))
+
+    if workers != 1:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    print('Made {} {} PDFs in {:.1f} seconds ({:.1f} PDFs/second){}{}'.format(
+        made, description, elapsed, made / max(elapsed, 1e-6),
+        ', {} failed'.format(failed) if failed else '',
+        ', {} already done'.format(skipped[0]) if skipped[0] else ''))
+
+def app_pdf_jobs(applicant_ids, anonymous, names=None):
+    for app in wufoo_entry_loader.iter_apps(fields=['full_name', 'questions']):
         app_name = app['full_name']
+        if names is not None and app_name not in names:
+            continue
         app_id = applicant_ids[app_name]
         if anonymous:
             pdf_title = 'Applicant #{}'.format(app_id)
@@ -32,15 +148,24 @@ def make_app_pdfs(applicant_ids, anonymous):
             pdf_title = '{} (#{})'.format(app_name, app_id)
             file_name = app_name + '.pdf'
 
-        wufoo_pdf = WufooPDF()
-        wufoo_pdf.append(app['questions'], pdf_title)
-        wufoo_pdf.save(os.path.join('apps/', file_name))
+        yield (pdf_title, os.path.join('apps/', file_name), app['questions'])
 
-def make_reference_pdfs(applicant_ids, anonymous):
-    references = wufoo_entry_loader.load_references(['applicant_full_name', 'questions'])
-    for i, reference in enumerate(references):
-        if i != 0 and i % 10 == 0:
-            print('Made {}/{} Letter of Reference PDFs'.format(i, len(references)))
+def make_app_pdfs(applicant_ids, anonymous, workers=None, names=None):
+    """Makes application PDFs (only for applicants in `names`, if given)."""
+    make_pdfs(app_pdf_jobs(applicant_ids, anonymous, names), 'Application', workers)
+
+def reference_pdf_jobs(applicant_ids, anonymous, names=None):
+    # An applicant with several references (which cross_reference.py reports)
+    # gets a PDF of the first one, as in their application packet (see
+    # `app_reader_folder.index_entries`). Otherwise every reference would be
+    # made into the same file.
+    seen = set()
+    for reference in wufoo_entry_loader.iter_references(['applicant_full_name', 'questions']):
+        if names is not None and reference['applicant_full_name'] not in names:
+            continue
+        if reference['applicant_full_name'] in seen:
+            continue
+        seen.add(reference['applicant_full_name'])
 
         # Applicant IDs come from the applications, so we don't have to try/catch
         # when looping over apps. Here, there may not exist an application for
@@ -60,19 +185,31 @@ def make_reference_pdfs(applicant_ids, anonymous):
             pdf_title = 'Reference for {} (#{})'.format(app_name, app_id)
             file_name = app_name + '.pdf'
 
-        wufoo_pdf = WufooPDF()
-        wufoo_pdf.append(reference['questions'], pdf_title)
-        wufoo_pdf.save(os.path.join('references/', file_name))
+        yield (pdf_title, os.path.join('references/', file_name), reference['questions'])
+
+def make_reference_pdfs(applicant_ids, anonymous, workers=None, names=None):
+    """Makes letter of reference PDFs (only for applicants in `names`, if given)."""
+    make_pdfs(reference_pdf_jobs(applicant_ids, anonymous, names), 'Letter of Reference', workers)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Make a PDF for each application and letter of reference.')
+    parser.add_argument('--workers', type=int, default=None,
+            help='number of processes making PDFs (default: one per CPU)')
+    return parser.parse_args()
+
+def run(anonymous, workers=None):
+    for directory in ('apps', 'references'):
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+    applicant_ids = load_applicant_ids()
+    make_app_pdfs(applicant_ids, anonymous, workers)
+    make_reference_pdfs(applicant_ids, anonymous, workers)
 
 def main():
+    args = parse_args()
     anonymous = raw_input('Would you like application PDFs to be anonymous (Y or N)? ')
     anonymous = anonymous.strip().lower() == 'y'
-    os.mkdir('apps')
-    os.mkdir('references')
-    applicant_ids = load_applicant_ids()
-    make_app_pdfs(applicant_ids, anonymous)
-    make_reference_pdfs(applicant_ids, anonymous)
+    run(anonymous, args.workers)
 
 if __name__ == '__main__':
-    main()
-
+    profiling.run(main)
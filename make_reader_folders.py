@@ -1,85 +1,207 @@
 from __future__ import print_function
 from collections import defaultdict
+import argparse
 import csv
+import multiprocessing
 import random
 import os
 import app_reader_folder
+import checkpoint
+import profiling
+import wufoo_entry_loader
 
 READERS_PER_APPLICANT = 2
 
+# Cells that don't mark a conflict. Besides blank cells, Google Sheets exports
+# unchecked checkboxes as FALSE.
+NO_CONFLICT = ('', 'false', '0', 'no', 'n')
+
+class ConflictMatrix(object):
+    """Conflicts of interest between readers and applicants, numbered by their
+    positions in `readers` and `applicants`. Bit i of `applicant_conflicts[j]`
+    is set if reader i has a conflict with applicant j.
+
+    Per-applicant conflict counts and eligible readers are worked out once,
+    here (most applicants have the same conflicts -- usually none -- so they
+    share a list of eligible readers).
+    """
+
+    def __init__(self, readers, applicants, applicant_conflicts):
+        self.readers = list(readers)
+        self.applicants = list(applicants)
+        self.applicant_index = dict((applicant, j) for (j, applicant) in enumerate(self.applicants))
+        self.applicant_conflicts = applicant_conflicts
+        self.conflict_counts = [bin(conflicts).count('1') for conflicts in applicant_conflicts]
+
+        self.eligible = {}  # conflict bits --> readers (in sorted order) without a conflict
+        for conflicts in set(applicant_conflicts) | set([0]):
+            self.eligible[conflicts] = sorted(
+                reader for (i, reader) in enumerate(self.readers) if not conflicts >> i & 1)
+
+    def conflicts(self, applicant):
+        j = self.applicant_index.get(applicant)
+        return self.applicant_conflicts[j] if j is not None else 0
+
+    def conflict_count(self, applicant):
+        j = self.applicant_index.get(applicant)
+        return self.conflict_counts[j] if j is not None else 0
+
+    def eligible_readers(self, applicant):
+        """Readers without a conflict with `applicant` (everyone, for applicants
+        missing from the spreadsheet). The list is shared, so don't modify it."""
+        return self.eligible[self.conflicts(applicant)]
+
 def load_conflicts_of_interest():
+    """Loads the conflicts of interest spreadsheet, after its round trip
+    through Google Sheets, as a ConflictMatrix. Blank columns and rows are
+    ignored, and any cell but a blank (or FALSE, 0, no...) marks a conflict."""
     with open(os.path.join('AppReading', 'conflicts_of_interest.csv')) as f:
         conflicts_reader = csv.reader(f)
-        reader_conflicts = dict((r, set()) for r in next(conflicts_reader)[1:])
+        header = next(conflicts_reader)
+        columns = [i for i in range(1, len(header)) if header[i].strip()]
+        readers = [header[i].strip() for i in columns]
+
+        applicants = []
+        applicant_conflicts = []
+        applicant_index = {}
         for row in conflicts_reader:
-            applicant = row[0]
-            for (reader, conflict_cell) in zip(reader_conflicts.keys(), row[1:]):
-                if conflict_cell:
-                    reader_conflicts[reader].add(applicant)
+            applicant = wufoo_entry_loader.normalize(row[0]) if row else ''
+            if not applicant:
+                continue
+            conflicts = 0
+            for (bit, i) in enumerate(columns):
+                if i < len(row) and row[i].strip().lower() not in NO_CONFLICT:
+                    conflicts |= 1 << bit
+            if applicant in applicant_index:
+                applicant_conflicts[applicant_index[applicant]] |= conflicts
+            else:
+                applicant_index[applicant] = len(applicants)
+                applicants.append(applicant)
+                applicant_conflicts.append(conflicts)
 
-    return reader_conflicts
+    return ConflictMatrix(readers, applicants, applicant_conflicts)
 
 def load_applicants():
     with open(os.path.join('AppReading', 'applicant_ids.csv')) as f:
         reader = csv.reader(f)
         return dict((row[0], row[1]) for row in reader)  # name --> id
 
-def make_app_assignments(name2id, conflicts_of_interest):
+class InfeasibleAssignmentError(Exception):
+    """Raised when some applicants can't get READERS_PER_APPLICANT readers."""
+
+    def __init__(self, applicant2readers):
+        self.applicant2readers = applicant2readers  # applicant --> eligible readers
+        Exception.__init__(self, '\n'.join(
+            '{} can only be read by {} reader(s) ({}), but needs {}.'.format(
+                name, len(readers), ', '.join(readers) or 'nobody', READERS_PER_APPLICANT)
+            for ((name, id_), readers) in sorted(applicant2readers.items())
+        ))
+
+@profiling.timed('make_app_assignments')
+def make_app_assignments(name2id, conflicts_of_interest, seed=None, initial_loads=None):
+    """Assigns READERS_PER_APPLICANT readers to each applicant (see
+    `load_conflicts_of_interest` for `conflicts_of_interest`), never assigning
+    a reader an applicant they have a conflict of interest with, and keeping
+    reader loads as balanced as the conflicts allow.
 
-    def count_conflicts(applicant):
-        return -sum(applicant[0] in conflicts
-                for conflicts in conflicts_of_interest.values())
+    We start with a greedy assignment (each applicant goes to the least-loaded
+    readers they can have), then repeatedly look for a chain of hand-offs that
+    moves one app from a reader with load k + 2 or more to a reader with load
+    k or less: reader 1 takes an app from reader 2, who takes an app from
+    reader 3, and so on. When no such chain exists, loads are optimally
+    balanced (in particular, the busiest reader reads as few apps as possible
+    and the least busy reader reads as many as possible). Everything runs in
+    polynomial time.
+
+    Runs with the same `seed` produce the same assignment.
+
+    `initial_loads` maps readers to the number of apps they already read (e.g.,
+    when assigning late applicants). Those assignments are left alone, but
+    count towards balancing.
+
+    Raises InfeasibleAssignmentError if some applicants have too few readers
+    without conflicts.
+    """
+    rng = random.Random(seed)
+    readers = sorted(conflicts_of_interest.readers)
+    applicants = sorted(name2id.items())
+
+    app2eligible = dict(
+        ((name, id_), conflicts_of_interest.eligible_readers(name))
+        for (name, id_) in applicants
+    )
+    infeasible = dict(
+        (applicant, eligible) for (applicant, eligible) in app2eligible.items()
+        if len(eligible) < READERS_PER_APPLICANT
+    )
+    if infeasible:
+        raise InfeasibleAssignmentError(infeasible)
 
     app2readers = defaultdict(list)
     reader2apps = defaultdict(list)
+    load = dict((reader, (initial_loads or {}).get(reader, 0)) for reader in readers)
+
+    # Greedy start. Applicants with the fewest options go first, since they're
+    # the hardest to place once readers fill up. Ties are broken randomly.
+    rng.shuffle(applicants)
+    applicants.sort(key=lambda applicant: -conflicts_of_interest.conflict_count(applicant[0]))
+    for applicant in applicants:
+        eligible = list(app2eligible[applicant])
+        rng.shuffle(eligible)
+        eligible.sort(key=lambda reader: load[reader])
+        for reader in eligible[:READERS_PER_APPLICANT]:
+            app2readers[applicant].append(reader)
+            reader2apps[reader].append(applicant)
+            load[reader] += 1
+
+    reader2eligible = defaultdict(list)  # reader --> applicants they could read
+    for applicant in applicants:
+        for reader in app2eligible[applicant]:
+            reader2eligible[reader].append(applicant)
 
-    readers = list(conflicts_of_interest.keys())
-
-    # Why do we sort by number of conflicts? Honestly, I'm not sure if it's a
-    # heuristic that I educationally-guessed would work well or if it
-    # mathematically works. It's easier to think about what would go wrong if
-    # we didn't do this.
-    #
-    # Suppose we have 2 applicants and 2 readers and 1 reader/app.  Reader 1
-    # has no conflicts. Reader 2 cannot read Applicant 2's app. Consider the
-    # case where we assign Reader 1 to read Applicant 1. Next, we look at
-    # Applicant 2 and see that only Reader 1 can read that app, so we assign it
-    # to Reader 1, also. But now Reader 1 is reading 2 apps and Reader 2 is
-    # reading none! Basically, this can cause imbalance.
-    #
-    # By sorting the list, we would first assign Reader 1 to Applicant 2.
-    # Then, we would consider Applicant 1, which could be assigned to Reader 2.
-    #
-    # NOTE: the way the current algorithm is implemented, it's not *guaranteed*
-    # that Reader 2 would be assigned to Applicant 1. We randomize the readers
-    # for each iteration so it tends to work out.
-    applicants = sorted(list(name2id.items()), key=count_conflicts)
-
-    # This continues assigning readers to applicants until no A single
-    # iteration iterates through all reader/applicant pairs and tries to assign
-    # them if possible. If a single iteration yields no changes in the
-    # assignment, we have done all we can do.
-    # 
-    # NOTE: This is a greedy algorithm so has the potential to fail in some
-    # cases. I would guess that that won't be too common, though, unless a few
-    # of the readers are *very* popular and aren't able to read many apps.
-    prev_assigned = -1
-    curr_assigned = 0
-    while curr_assigned > prev_assigned:
-        prev_assigned = curr_assigned
-
-        # Randomizing readers avoids the scenario where the same pairs of readers
-        # are assigned to applicants.
-        random.shuffle(readers)
-        for reader in readers:
-            for (name, id_) in applicants:
-                if name not in conflicts_of_interest[reader] and \
-                        (name, id_) not in reader2apps[reader] and \
-                        len(app2readers[(name, id_)]) < READERS_PER_APPLICANT:
-                    curr_assigned += 1
-                    app2readers[(name, id_)].append(reader)
-                    reader2apps[reader].append((name, id_))
-                    break
+    def find_hand_offs(max_load):
+        """Finds a chain of hand-offs from some reader with load <= max_load to
+        one with load >= max_load + 2, as a list of (taker, app, giver)."""
+        queue = [r for r in readers if load[r] <= max_load]
+        parent = dict((r, None) for r in queue)
+        for taker in queue:  # the queue grows as we go (BFS)
+            taken = set(reader2apps[taker])
+            for applicant in reader2eligible[taker]:
+                if applicant in taken:
+                    continue
+                for giver in app2readers[applicant]:
+                    if giver in parent:
+                        continue
+                    parent[giver] = (taker, applicant)
+                    if load[giver] >= max_load + 2:
+                        chain = []
+                        while parent[giver] is not None:
+                            (taker, applicant) = parent[giver]
+                            chain.append((taker, applicant, giver))
+                            giver = taker
+                        return chain
+                    queue.append(giver)
+        return None
+
+    improved = True
+    while improved:
+        improved = False
+        for max_load in range(min(load.values()), max(load.values()) - 1):
+            # Readers can only give away apps assigned here.
+            if not any(reader2apps[r] for r in readers if load[r] >= max_load + 2):
+                continue
+            chain = find_hand_offs(max_load)
+            if chain is None:
+                continue
+            for (taker, applicant, giver) in chain:
+                reader2apps[giver].remove(applicant)
+                app2readers[applicant].remove(giver)
+                reader2apps[taker].append(applicant)
+                app2readers[applicant].append(taker)
+            load[chain[-1][0]] += 1
+            load[chain[0][2]] -= 1
+            improved = True
+            break
 
     return reader2apps, app2readers
 
@@ -92,6 +214,18 @@ def save_app_assignments(reader2apps, app2readers):
             (name, id_) = applicant
             writer.writerow([name] + [('x' if reader in app_readers else '') for reader in readers])
 
+def append_app_assignments(app2readers):
+    """Adds rows for newly assigned applicants to app_read_assignments.csv,
+    leaving existing rows (and columns) as they are."""
+    path = os.path.join('AppReading', 'app_read_assignments.csv')
+    with open(path) as f:
+        readers = next(csv.reader(f))[1:]
+    with open(path, 'a') as f:
+        writer = csv.writer(f)
+        for (applicant, app_readers) in app2readers.items():
+            (name, id_) = applicant
+            writer.writerow([name] + [('x' if reader in app_readers else '') for reader in readers])
+
 def load_app_assignments(applicants):
     reader2apps = defaultdict(list)
     with open(os.path.join('AppReading', 'app_read_assignments.csv')) as f:
@@ -105,23 +239,124 @@ def load_app_assignments(applicants):
                 reader2apps[reader].append((name, id_))
     return reader2apps
 
-def make_reader_folders(reader2apps):
-    for (reader, applicants) in reader2apps.items():
-        random.shuffle(applicants)
+# Fragments shared by every packet built in this process. Set once per worker
+# (see `init_packet_worker`) so they aren't re-sent with each task.
+packet_fragments = None
+
+def init_packet_worker(fragments):
+    global packet_fragments
+    packet_fragments = fragments
+
+def render_applicant_fragments(applicants):
+    rendered = packet_fragments.render_all(applicants)
+    profiling.flush()
+    return rendered
+
+def make_reader_folder(reader_applicants):
+    (reader, applicants) = reader_applicants
+    folder = app_reader_folder.AppReaderFolder(reader, applicants, packet_fragments)
+    folder.make_app_packet()
+    profiling.flush()
+    return reader
+
+def chunks(items, n):
+    """Splits `items` into at most `n` contiguous chunks."""
+    size = max(1, -(-len(items) // n))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def make_reader_folders(reader2apps, workers=None, resume=False):
+    """Builds each reader's score sheet and application packet, using a pool of
+    `workers` processes (one per CPU by default). When resuming, existing
+    score sheets are left alone, since readers may have started scoring.
+
+    Each applicant's pages are laid out once (see PacketFragments), then
+    reader packets are stitched together from those pages. Packets already
+    made from the same applicants, apps and references (by an earlier,
+    possibly interrupted, run) are skipped.
+    """
+    fingerprints = wufoo_entry_loader.current_fingerprints()
+    journal = checkpoint.Journal(app_reader_folder.PACKET_JOURNAL_FILE)
+    jobs = []
+    packets = {}  # reader --> (packet file, inputs)
+    for reader in sorted(reader2apps.keys()):
+        applicants = app_reader_folder.packet_order(reader, reader2apps[reader])
         folder = app_reader_folder.AppReaderFolder(reader, applicants)
-        folder.make_score_sheet()
-        folder.make_app_packet()
+        inputs = app_reader_folder.packet_inputs(reader, 'Application Packet', applicants, fingerprints)
+        folder.make_score_sheet(overwrite=not resume)
+        if journal.is_done(folder.packet_path(), inputs):
+            print('{}\'s folder is already done'.format(reader))
+            continue
+        jobs.append((reader, applicants))
+        packets[reader] = (folder.packet_path(), inputs)
 
-def main():
-    conflicts_of_interest = load_conflicts_of_interest()
+    if not jobs:
+        return
+
+    fragments = app_reader_folder.PacketFragments(app_reader_folder.load_packet_entries())
+    applicants = sorted(set(applicant for (_, applicants) in jobs for applicant in applicants))
+    workers = workers or multiprocessing.cpu_count()
+
+    if workers == 1:
+        init_packet_worker(fragments)
+        fragments.render_all(applicants)
+        finished = (make_reader_folder(job) for job in jobs)
+    else:
+        pool = multiprocessing.Pool(workers, init_packet_worker, (fragments,))
+        for rendered in pool.imap(render_applicant_fragments, chunks(applicants, workers * 4)):
+            fragments.update(rendered)
+        pool.close()
+        pool.join()
+
+        pool = multiprocessing.Pool(workers, init_packet_worker, (fragments,))
+        finished = pool.imap_unordered(make_reader_folder, jobs)
+
+    print('Rendered pages for {} applicants'.format(len(applicants)))
+    for (i, reader) in enumerate(finished):
+        journal.record(*packets[reader])
+        print('Made folder for {} ({}/{})'.format(reader, i + 1, len(jobs)))
+
+    if workers != 1:
+        pool.close()
+        pool.join()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Assign applicants to readers and build reader folders.')
+    parser.add_argument('--workers', type=int, default=None,
+            help='number of processes building packets (default: one per CPU)')
+    parser.add_argument('--seed', type=int, default=None,
+            help='seed for assigning readers, so assignments can be reproduced')
+    parser.add_argument('--resume', action='store_true',
+            help='keep the existing app_read_assignments.csv and only make folders that aren\'t done yet')
+    return parser.parse_args()
+
+def run(workers=None, seed=None, resume=False):
     applicants = load_applicants()
-    reader2apps, app2readers = make_app_assignments(applicants, conflicts_of_interest)
+    if resume and os.path.exists(os.path.join('AppReading', 'app_read_assignments.csv')):
+        make_reader_folders(load_app_assignments(applicants), workers, resume=True)
+        wufoo_entry_loader.save_processed_fingerprints()
+        return True
+
+    conflicts_of_interest = load_conflicts_of_interest()
+    try:
+        reader2apps, app2readers = make_app_assignments(applicants, conflicts_of_interest, seed)
+    except InfeasibleAssignmentError as e:
+        print('Couldn\'t assign readers to every applicant:')
+        print(e)
+        return False
     save_app_assignments(reader2apps, app2readers)
     print('Quickly inspect app assignments in app_read_assignments.csv to make sure ' +\
             'nothing looks fishy (enter to continue)...')
     raw_input()
-    make_reader_folders(reader2apps)
+    make_reader_folders(reader2apps, workers)
+
+    # Lets ingest_late_entries.py tell which entries arrive after this point.
+    wufoo_entry_loader.save_processed_fingerprints()
+    return True
+
+def main():
+    args = parse_args()
+    run(args.workers, args.seed, args.resume)
 
 if __name__ == '__main__':
-    main()
+    profiling.run(main)
 
@@ -0,0 +1,195 @@
+"""This script makes fake Wufoo exports, for trying out and benchmarking the
+other scripts without real (confidential!) applications.
+
+It writes `apps.csv`, `references.csv` and `conflicts_of_interest.csv` to the
+`AppReading` directory and `camper_info.csv` to the current directory, with the
+same column layouts `wufoo_entry_loader.load_apps`, `load_references` and
+`make_camper_files` expect.
+
+Example: `python make_synthetic_exports.py --applicants 5000 --seed 1`
+"""
+from __future__ import print_function
+import argparse
+import csv
+import os
+import profiling
+import random
+import wufoo_entry_loader
+
+APP_COLUMNS = 40                # 0-indexed columns in apps.csv
+REFERENCE_COLUMNS = 28          # and in references.csv
+APP_QUESTION_COLUMNS = range(16, 35)
+REFERENCE_QUESTION_COLUMNS = range(7, 24)
+GRADE_COLUMNS = range(16, 23)   # grade preferences, answered with a short rank
+
+SCHOOL_YEARS = ['Freshman', 'Sophomore', 'Junior', 'Senior', 'Co-Term']
+GENDERS = ['Male', 'male', 'M', 'Female', 'female', 'woman', 'F', 'Nonbinary', 'genderqueer', 'Agender']
+UNITS = ['Bumblebees', 'Dolphins', 'Eagles', 'Foxes', 'Koalas', 'Otters', 'Pandas', 'Tigers']
+
+CONSONANTS = 'bcdfghjklmnprstvwz'
+VOWELS = 'aeiou'
+WORDS = ('camp kesem kids counselor cancer family support community summer friends games '
+         'leadership responsibility growth listen laugh energy teach learn volunteer school '
+         'team patient creative kind trust safe fun songs cabin lake hike art music').split()
+
+def make_header(columns, headers, questions, question_columns):
+    """Wufoo's header row, with the headers `wufoo_entry_loader` looks for."""
+    header = ['Entry Id'] + ['Field{}'.format(i) for i in range(1, columns - 1)] + ['Completion Status']
+    for (i, name) in headers.items():
+        header[i] = name
+    for (i, question) in zip(question_columns, questions):
+        header[i] = question[1] if isinstance(question, tuple) else question
+    return header
+
+def make_name(rng):
+    syllables = rng.randint(2, 3)
+    return ''.join(rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(syllables)).title()
+
+def misspell(rng, name):
+    """Drops, doubles or swaps a letter."""
+    i = rng.randrange(1, len(name))
+    edit = rng.choice(['drop', 'double', 'swap'])
+    if edit == 'drop':
+        return name[:i] + name[i + 1:]
+    elif edit == 'double':
+        return name[:i] + name[i] + name[i:]
+    else:
+        return name[:i - 1] + name[i] + name[i - 1] + name[i + 1:]
+
+def make_answer(rng, length):
+    words = [rng.choice(WORDS) for _ in range(max(1, int(rng.gauss(length, length / 4.0))))]
+    # Break long answers into paragraphs, like real ones.
+    for i in range(60, len(words), 60):
+        words[i] += '\n'
+    return ' '.join(words).capitalize() + '.'
+
+def make_timestamp(rng, month):
+    return '2017-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(
+        month, rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+
+def make_applicants(rng, count):
+    applicants = []
+    names = set()
+    while len(applicants) < count:
+        (first_name, last_name) = (make_name(rng), make_name(rng))
+        if (first_name, last_name) not in names:
+            names.add((first_name, last_name))
+            applicants.append((first_name, last_name))
+    return applicants
+
+def write_apps(rng, applicants, args):
+    with open(os.path.join('AppReading', 'apps.csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(make_header(APP_COLUMNS,
+            {1: 'First Name', 2: 'Last Name', 5: 'Gender', 7: 'Year in School', 9: 'Email', 37: 'Date Created'},
+            wufoo_entry_loader.APP_QUESTIONS, APP_QUESTION_COLUMNS))
+        entry_id = 0
+        for (first_name, last_name) in applicants:
+            submissions = 2 if rng.random() < args.duplicate_rate else 1
+            for _ in range(submissions):
+                entry_id += 1
+                row = [''] * APP_COLUMNS
+                row[0] = str(entry_id)
+                (row[1], row[2]) = (first_name, last_name)
+                row[5] = rng.choice(GENDERS)
+                row[7] = rng.choice(SCHOOL_YEARS)
+                row[9] = '{}.{}@example.edu'.format(first_name, last_name).lower()
+                for i in APP_QUESTION_COLUMNS:
+                    if i in GRADE_COLUMNS:
+                        row[i] = str(rng.randint(1, 7))
+                    else:
+                        row[i] = make_answer(rng, args.answer_length)
+                row[37] = make_timestamp(rng, 1)
+                row[-1] = '1' if rng.random() < 0.98 else '0'
+                writer.writerow(row)
+
+def write_references(rng, applicants, args):
+    with open(os.path.join('AppReading', 'references.csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(make_header(REFERENCE_COLUMNS,
+            {1: 'First Name', 2: 'Last Name', 5: 'Applicant First Name', 6: 'Applicant Last Name', 26: 'Date Created'},
+            wufoo_entry_loader.REFERENCE_QUESTIONS, REFERENCE_QUESTION_COLUMNS))
+        entry_id = 0
+        for (first_name, last_name) in applicants:
+            if rng.random() < args.missing_reference_rate:
+                continue
+            submissions = 2 if rng.random() < args.duplicate_rate else 1
+            for _ in range(submissions):
+                entry_id += 1
+                row = [''] * REFERENCE_COLUMNS
+                row[0] = str(entry_id)
+                (row[1], row[2]) = (make_name(rng), make_name(rng))
+                (row[5], row[6]) = (first_name, last_name)
+                if rng.random() < args.misspelling_rate:
+                    if rng.random() < 0.5:
+                        row[5] = misspell(rng, first_name)
+                    else:
+                        row[6] = misspell(rng, last_name)
+                for i in REFERENCE_QUESTION_COLUMNS:
+                    row[i] = make_answer(rng, args.answer_length // 2)
+                row[26] = make_timestamp(rng, 2)
+                row[-1] = '1'
+                writer.writerow(row)
+
+def write_conflicts_of_interest(rng, applicants, args):
+    readers = ['Reader {}'.format(i + 1) for i in range(args.readers)]
+    with open(os.path.join('AppReading', 'conflicts_of_interest.csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow([''] + readers)
+        for (first_name, last_name) in applicants:
+            name = (first_name + ' ' + last_name).lower()
+            writer.writerow([name] + [('x' if rng.random() < args.conflict_density else '') for _ in readers])
+
+def write_camper_info(rng, args):
+    with open('camper_info.csv', 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Camper', 'Unit', 'Age', 'Allergies', 'Medications', 'Notes'])
+        for _ in range(args.campers):
+            writer.writerow([
+                make_name(rng) + ' ' + make_name(rng),
+                rng.choice(UNITS),
+                str(rng.randint(6, 16)),
+                rng.choice(['None', 'Peanuts', 'Gluten', 'Bees']),
+                rng.choice(['None', 'Inhaler', 'Epipen']),
+                make_answer(rng, args.answer_length // 4),
+            ])
+
+def make_synthetic_exports(args):
+    rng = random.Random(args.seed)
+    if not os.path.isdir('AppReading'):
+        os.mkdir('AppReading')
+    applicants = make_applicants(rng, args.applicants)
+    write_apps(rng, applicants, args)
+    write_references(rng, applicants, args)
+    write_conflicts_of_interest(rng, applicants, args)
+    write_camper_info(rng, args)
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Make fake Wufoo exports for testing and benchmarking.')
+    parser.add_argument('--applicants', type=int, default=1000,
+            help='number of distinct applicants (default: 1000)')
+    parser.add_argument('--answer-length', type=int, default=120,
+            help='average words per application answer; reference answers are half as long (default: 120)')
+    parser.add_argument('--duplicate-rate', type=float, default=0.02,
+            help='fraction of applicants (and references) submitted twice (default: 0.02)')
+    parser.add_argument('--misspelling-rate', type=float, default=0.03,
+            help='fraction of references that misspell the applicant\'s name (default: 0.03)')
+    parser.add_argument('--missing-reference-rate', type=float, default=0.02,
+            help='fraction of applicants without a reference (default: 0.02)')
+    parser.add_argument('--readers', type=int, default=20,
+            help='number of readers in the conflicts of interest spreadsheet (default: 20)')
+    parser.add_argument('--conflict-density', type=float, default=0.02,
+            help='chance a reader has a conflict with any given applicant (default: 0.02)')
+    parser.add_argument('--campers', type=int, default=200,
+            help='number of campers in camper_info.csv (default: 200)')
+    parser.add_argument('--seed', type=int, default=0,
+            help='random seed (default: 0)')
+    return parser
+
+def main():
+    args = make_parser().parse_args()
+    make_synthetic_exports(args)
+    print('Wrote fake exports for {} applicants.'.format(args.applicants))
+
+if __name__ == '__main__':
+    profiling.run(main)
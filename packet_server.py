@@ -0,0 +1,243 @@
+"""This script serves application PDFs, letters of reference and reader packets
+from this computer, making each one the first time it's opened instead of
+making all of them ahead of time.
+
+    python packet_server.py
+
+Then open http://localhost:8000/ for links to every reader's packet and every
+applicant's app and reference (by applicant ID, so they stay anonymous).
+
+Made PDFs are kept in memory (up to `--cache-mb` megabytes, dropping the
+least recently opened ones first). Whenever the exports, applicant IDs or
+reader assignments change, PDFs whose apps or references changed are made
+again the next time they're opened; everything else is still served from
+memory. Browsers are told to check back each time, and only download a PDF
+again if it changed.
+"""
+from __future__ import print_function
+from collections import OrderedDict
+import argparse
+import io
+import os
+import app_reader_folder
+import assign_applicant_ids
+import checkpoint
+import make_reader_folders
+import profiling
+import wufoo_entry_loader
+import wufoo_pdf
+
+try:
+    from html import escape
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import quote, unquote
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from cgi import escape
+    from urllib import quote, unquote
+
+APP_READ_ASSIGNMENTS = os.path.join('AppReading', 'app_read_assignments.csv')
+
+# Files PDFs are made from. When any of them change, we reload everything.
+SOURCES = [
+    wufoo_entry_loader.APPS_FILE,
+    wufoo_entry_loader.REFERENCES_FILE,
+    assign_applicant_ids.APPLICANT_IDS_FILE,
+    APP_READ_ASSIGNMENTS,
+]
+
+def source_stats():
+    return dict(
+        (path, (os.stat(path).st_size, os.stat(path).st_mtime))
+        for path in SOURCES if os.path.exists(path))
+
+class LRUCache(object):
+    """Maps keys to bytes, dropping the least recently used entries once they
+    add up to more than `max_bytes`."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # least recently used first
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        if len(value) > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            (_, dropped) = self.entries.popitem(last=False)
+            self.size -= len(dropped)
+
+def render_pdf(render):
+    """Returns the bytes of a PDF laid out by `render(pdf)`."""
+    out = io.BytesIO()
+    pdf = wufoo_pdf.WufooPDF(stream_to=out)
+    render(pdf)
+    pdf.finish()
+    return out.getvalue()
+
+class PacketLibrary(object):
+    """Everything PDFs are made from, reloaded when the files it comes from
+    change.
+
+    Each PDF is identified by a hash of everything it's made from (see
+    `checkpoint.hash_inputs`), which doubles as its ETag and cache key. So
+    when an app changes, its hash (and every packet it's in) changes too,
+    while other PDFs keep theirs.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.sources = None
+
+    def refresh(self):
+        sources = source_stats()
+        if sources == self.sources:
+            return
+        self.sources = sources
+        wufoo_entry_loader.loaded_snapshots.clear()
+        self.packet_entries = app_reader_folder.load_packet_entries()
+        # Shared by every packet until the sources change, so an applicant's
+        # pages are laid out once however many readers' packets they're in.
+        self.packet_fragments = app_reader_folder.PacketFragments(self.packet_entries)
+        self.fingerprints = wufoo_entry_loader.current_fingerprints()
+        self.applicant_ids = assign_applicant_ids.load_applicant_ids()
+        self.id2name = dict((id_, name) for (name, id_) in self.applicant_ids.items())
+        self.reader2apps = {}
+        if os.path.exists(APP_READ_ASSIGNMENTS):
+            self.reader2apps = make_reader_folders.load_app_assignments(self.applicant_ids)
+
+    def find(self, kind, key):
+        """Returns (ETag, function making the PDF) for a PDF, or None if there's
+        no such PDF. `kind` is 'apps', 'references' or 'readers'; `key` is an
+        applicant ID or a reader's name."""
+        (apps, references) = self.packet_entries
+        if kind == 'readers':
+            if key not in self.reader2apps:
+                return None
+            applicants = app_reader_folder.packet_order(key, self.reader2apps[key])
+            etag = app_reader_folder.packet_inputs(key, 'Application Packet', applicants, self.fingerprints)
+            fragments = self.packet_fragments
+            return (etag, lambda pdf: app_reader_folder.add_app_packet(pdf, key, applicants, fragments))
+
+        name = self.id2name.get(key)
+        if kind == 'apps' and name in apps:
+            (title, questions) = ('Applicant #{}'.format(key), apps[name]['questions'])
+        elif kind == 'references' and name in references:
+            (title, questions) = ('Reference for Applicant #{}'.format(key), references[name]['questions'])
+        else:
+            return None
+        return (checkpoint.hash_inputs(title, questions), lambda pdf: pdf.append(questions, title))
+
+    def get(self, kind, key):
+        """Returns (ETag, function returning the PDF's bytes), or None."""
+        found = self.find(kind, key)
+        if found is None:
+            return None
+        (etag, render) = found
+
+        def pdf_bytes():
+            data = self.cache.get(etag)
+            if data is None:
+                with profiling.span('packet_server.render.' + kind) as span:
+                    data = render_pdf(render)
+                    span.add(bytes=len(data))
+                self.cache.put(etag, data)
+            return data
+        return (etag, pdf_bytes)
+
+    def index_page(self):
+        def links(kind, keys, label):
+            return ''.join(
+                '<li><a href="/{}/{}.pdf">{}</a></li>'.format(kind, quote(key), escape(label(key)))
+                for key in keys)
+
+        (apps, references) = self.packet_entries
+        ids = sorted((id_ for (id_, name) in self.id2name.items() if name in apps), key=int)
+        return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Application Reading</title></head>'
+                '<body><h1>Reader Packets</h1><ul>{}</ul><h1>Applications</h1><ul>{}</ul></body></html>').format(
+            links('readers', sorted(self.reader2apps.keys()), lambda reader: reader + '\'s Application Packet'),
+            ''.join(
+                '<li>Applicant #{0}: <a href="/apps/{0}.pdf">app</a>{1}</li>'.format(
+                    id_, ' | <a href="/references/{}.pdf">reference</a>'.format(id_)
+                    if self.id2name[id_] in references else '')
+                for id_ in ids))
+
+class PacketRequestHandler(BaseHTTPRequestHandler):
+    library = None  # set by `serve`
+
+    def do_GET(self):
+        self.library.refresh()
+        path = unquote(self.path.split('?')[0]).strip('/')
+        if path == '':
+            self.send_body(self.library.index_page().encode('utf-8'), 'text/html; charset=utf-8')
+            return
+
+        (kind, _, file_name) = path.partition('/')
+        found = None
+        if file_name.endswith('.pdf'):
+            found = self.library.get(kind, file_name[:-len('.pdf')])
+        if found is None:
+            self.send_error(404, 'No such PDF')
+            return
+
+        (etag, pdf_bytes) = found
+        etag = '"{}"'.format(etag)
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_body(pdf_bytes(), 'application/pdf', etag)
+
+    do_HEAD = do_GET
+
+    def send_body(self, body, content_type, etag=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        # Browsers may keep PDFs, but must check with us (by ETag) before
+        # showing them again.
+        self.send_header('Cache-Control', 'no-cache')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+def serve(port, cache_mb):
+    PacketRequestHandler.library = PacketLibrary(LRUCache(cache_mb * 1000 * 1000))
+    PacketRequestHandler.library.refresh()
+    # Only this computer can connect.
+    server = HTTPServer(('127.0.0.1', port), PacketRequestHandler)
+    print('Serving PDFs at http://localhost:{}/ (press Ctrl-C to stop)'.format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve apps, references and reader packets, making each PDF when it\'s first opened.')
+    parser.add_argument('--port', type=int, default=8000,
+            help='port to serve on (default: 8000)')
+    parser.add_argument('--cache-mb', type=int, default=200,
+            help='megabytes of PDFs to keep in memory (default: 200)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    serve(args.port, args.cache_mb)
+
+if __name__ == '__main__':
+    profiling.run(main)
@@ -0,0 +1,200 @@
+"""Runs the application-reading scripts in order, skipping stages that are
+already up to date (like make).
+
+Each stage declares the files it reads and writes. After a stage runs, we
+record content hashes of those files in AppReading/pipeline_manifest.json. A
+stage runs again only if it never ran, or if any of its inputs or outputs
+changed since it last ran. Every stage runs in this one process, so apps and
+references are loaded once and shared by all of them.
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import os
+import assign_applicant_ids
+import checkpoint
+import cross_reference
+import make_conflicts_of_interest_spreadsheet
+import profiling
+import search_answers
+import wufoo_entry_loader
+
+MANIFEST_FILE = os.path.join('AppReading', 'pipeline_manifest.json')
+
+APPS = os.path.join('AppReading', 'apps.csv')
+REFERENCES = os.path.join('AppReading', 'references.csv')
+APPLICANT_IDS = os.path.join('AppReading', 'applicant_ids.csv')
+CONFLICTS_OF_INTEREST = os.path.join('AppReading', 'conflicts_of_interest.csv')
+APP_READ_ASSIGNMENTS = os.path.join('AppReading', 'app_read_assignments.csv')
+
+class Stage(object):
+    def __init__(self, name, run, inputs, outputs, create_only=False):
+        self.name = name
+        self.run = run            # fn(args) --> False if the pipeline should stop
+        self.inputs = inputs
+        self.outputs = outputs
+        # Stages whose outputs get edited by hand afterwards (e.g., readers mark
+        # conflicts of interest) only run to create missing outputs.
+        self.create_only = create_only
+
+def run_cross_reference(args):
+    issues = cross_reference.main()
+    if issues == 0 or args.force:
+        return True
+    answer = raw_input('cross_reference.py found {} issue(s) to fix. Continue anyway (Y or N)? '.format(issues))
+    return answer.strip().lower() == 'y'
+
+def run_assign_applicant_ids(args):
+    # IDs must never change once assigned, so after the first run we only give
+    # IDs to new applicants.
+    if os.path.exists(APPLICANT_IDS):
+        apps = wufoo_entry_loader.iter_apps(fields=['full_name'])
+        assign_applicant_ids.add_applicant_ids(app['full_name'] for app in apps)
+    else:
+        assign_applicant_ids.main()
+    return True
+
+def run_make_conflicts_of_interest_spreadsheet(args):
+    make_conflicts_of_interest_spreadsheet.main()
+    print('Once readers have marked their conflicts, put the CSV back in AppReading/ and run this again.')
+    return False
+
+# Stages that make PDFs import them when they run, so checking which stages
+# are out of date doesn't load fpdf.
+def run_make_reader_folders(args):
+    # Readers are assigned once. After that, changed exports only bring late
+    # entries, which get readers (and packets) of their own without touching
+    # existing assignments, packets or score sheets.
+    if os.path.exists(APP_READ_ASSIGNMENTS):
+        import ingest_late_entries
+        return ingest_late_entries.run(args.workers, args.seed, not args.unanonymized)
+    import make_reader_folders
+    return make_reader_folders.run(args.workers, args.seed)
+
+def run_make_individual_pdfs(args):
+    import make_individual_pdfs
+    make_individual_pdfs.run(not args.unanonymized, args.workers)
+    return True
+
+def run_update_search_index(args):
+    (_, added, removed) = search_answers.update_index()
+    print('Indexed {} new or changed apps and references ({} removed or replaced).'.format(added, removed))
+    return True
+
+STAGES = [
+    Stage('cross_reference', run_cross_reference,
+        inputs=[APPS, REFERENCES], outputs=[]),
+    Stage('assign_applicant_ids', run_assign_applicant_ids,
+        inputs=[APPS], outputs=[APPLICANT_IDS]),
+    Stage('make_conflicts_of_interest_spreadsheet', run_make_conflicts_of_interest_spreadsheet,
+        inputs=[APPLICANT_IDS], outputs=[CONFLICTS_OF_INTEREST], create_only=True),
+    Stage('make_reader_folders', run_make_reader_folders,
+        inputs=[APPS, REFERENCES, APPLICANT_IDS, CONFLICTS_OF_INTEREST], outputs=[APP_READ_ASSIGNMENTS]),
+    Stage('make_individual_pdfs', run_make_individual_pdfs,
+        inputs=[APPS, REFERENCES, APPLICANT_IDS], outputs=['apps', 'references']),
+    Stage('update_search_index', run_update_search_index,
+        inputs=[APPS, REFERENCES, APPLICANT_IDS], outputs=[search_answers.INDEX_FILE]),
+]
+
+def hash_path(path):
+    """Hashes a file's contents, or the names and contents of every file in a
+    directory. Missing paths hash to None."""
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha1()
+    if os.path.isdir(path):
+        for (directory, subdirectories, file_names) in sorted(os.walk(path)):
+            subdirectories.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(directory, file_name)
+                digest.update(os.path.relpath(file_path, path).encode('utf-8'))
+                digest.update(checkpoint.hash_file(file_path).encode('utf-8'))
+    else:
+        digest.update(checkpoint.hash_file(path).encode('utf-8'))
+    return digest.hexdigest()
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    with open(MANIFEST_FILE) as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    with open(MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+def out_of_date(stage, manifest, changed_paths):
+    """Returns why `stage` needs to run, or None if it's up to date.
+
+    `changed_paths` are paths that earlier stages are about to rewrite (when
+    doing a dry run), which we can't hash ahead of time.
+    """
+    missing = [path for path in stage.outputs if not os.path.exists(path)]
+    if stage.create_only:
+        return 'missing {}'.format(', '.join(missing)) if missing else None
+    if missing:
+        return 'missing {}'.format(', '.join(missing))
+    if stage.name not in manifest:
+        return 'never ran'
+
+    recorded = manifest[stage.name]
+    changed = [
+        path for path in stage.inputs + stage.outputs
+        if path in changed_paths or recorded.get(path) != hash_path(path)
+    ]
+    return 'changed {}'.format(', '.join(changed)) if changed else None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run every out-of-date stage of the application-reading pipeline.')
+    parser.add_argument('stages', nargs='*', metavar='stage',
+            help='stages to consider (default: all of them, in order): ' +
+                 ', '.join(stage.name for stage in STAGES))
+    parser.add_argument('--dry-run', action='store_true',
+            help='only show which stages would run')
+    parser.add_argument('--force', action='store_true',
+            help='run the given stages even if up to date (except ones whose output is edited by hand), '
+                 'and don\'t stop for cross_reference issues')
+    parser.add_argument('--unanonymized', action='store_true',
+            help='put applicant names (instead of IDs) on individual PDFs')
+    parser.add_argument('--workers', type=int, default=None,
+            help='number of processes making PDFs (default: one per CPU)')
+    parser.add_argument('--seed', type=int, default=None,
+            help='seed for assigning readers, so assignments can be reproduced')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    names = [stage.name for stage in STAGES]
+    for name in args.stages:
+        if name not in names:
+            raise SystemExit('Unknown stage: {} (expected one of {})'.format(name, ', '.join(names)))
+
+    manifest = load_manifest()
+    changed_paths = set()
+    for stage in STAGES:
+        if args.stages and stage.name not in args.stages:
+            continue
+
+        reason = out_of_date(stage, manifest, changed_paths)
+        if args.force and reason is None and not stage.create_only:
+            reason = 'forced'
+        if reason is None:
+            print('{}: up to date{}'.format(
+                stage.name, ' (not forced, since its output is edited by hand)' if args.force and stage.create_only else ''))
+            continue
+
+        print('{}: {}{}'.format(stage.name, 'would run' if args.dry_run else 'running', ' ({})'.format(reason)))
+        if args.dry_run:
+            changed_paths.update(stage.outputs)
+            continue
+
+        if not stage.run(args):
+            print('Stopping after {}.'.format(stage.name))
+            break
+        manifest[stage.name] = dict(
+            (path, hash_path(path)) for path in stage.inputs + stage.outputs)
+        save_manifest(manifest)
+
+if __name__ == '__main__':
+    profiling.run(main)
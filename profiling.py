@@ -0,0 +1,167 @@
+"""Helper library for profiling the scripts in this repo.
+
+Run any script with `--profile` (or `--profile=some_file.json`) to time its hot
+paths -- loading CSVs, laying out PDFs, writing PDFs to disk and so on. When
+the script finishes, we print a summary table (calls, wall time, CPU time,
+bytes written and pages produced for each span) and save every span as a
+Chrome trace (open it at chrome://tracing or https://ui.perfetto.dev).
+
+Code marks its hot paths with `span` (a context manager) or `timed` (a
+decorator). Both do next to nothing unless profiling is enabled.
+
+Worker processes inherit profiling through an environment variable. They
+should call `flush` at the end of each task, since pool workers exit without
+running any cleanup code.
+"""
+from __future__ import print_function
+from collections import defaultdict
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+DEFAULT_TRACE_FILE = 'profile_trace.json'
+
+# Directory where each process saves its spans. Set (in the environment, so
+# worker processes see it too) only while profiling.
+TRACE_DIR_VARIABLE = 'KESEM_PROFILE_DIR'
+
+trace_dir = os.environ.get(TRACE_DIR_VARIABLE)
+enabled = trace_dir is not None
+events = []  # finished spans not yet flushed, as Chrome trace events
+
+process_time = getattr(time, 'process_time', None) or time.clock
+
+class Span(object):
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+        self.counters = {}
+
+    def add(self, **counters):
+        """Adds to the span's counters (e.g., `bytes` or `pages`)."""
+        for (counter, value) in counters.items():
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def __enter__(self):
+        self.start = time.time()
+        self.start_cpu = process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.time()
+        args = dict(self.counters, cpu_ms=(process_time() - self.start_cpu) * 1000)
+        events.append({
+            'name': self.name,
+            'cat': self.category,
+            'ph': 'X',
+            'ts': self.start * 1e6,
+            'dur': (end - self.start) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        })
+
+class NoSpan(object):
+    """Stands in for a Span when profiling is disabled."""
+
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NO_SPAN = NoSpan()
+
+def span(name, category='kesem'):
+    return Span(name, category) if enabled else NO_SPAN
+
+def timed(name, category='kesem'):
+    """Decorates a function so each call is recorded as a span."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with Span(name, category):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def flush():
+    """Saves this process's finished spans for the final report."""
+    if not enabled or not events:
+        return
+    with open(os.path.join(trace_dir, '{}.jsonl'.format(os.getpid())), 'a') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+    del events[:]
+
+def collect_events():
+    collected = []
+    for file_name in sorted(os.listdir(trace_dir)):
+        with open(os.path.join(trace_dir, file_name)) as f:
+            collected.extend(json.loads(line) for line in f)
+    return sorted(collected, key=lambda event: event['ts'])
+
+def print_summary(collected, out=sys.stdout):
+    totals = defaultdict(lambda: defaultdict(float))
+    for event in collected:
+        total = totals[event['name']]
+        total['calls'] += 1
+        total['wall_ms'] += event['dur'] / 1000
+        for (counter, value) in event['args'].items():
+            total[counter] += value
+
+    print(file=out)
+    print('{:<40} {:>8} {:>12} {:>12} {:>12} {:>8}'.format(
+        'span', 'calls', 'wall (ms)', 'cpu (ms)', 'bytes', 'pages'), file=out)
+    for (name, total) in sorted(totals.items(), key=lambda item: -item[1]['wall_ms']):
+        print('{:<40} {:>8} {:>12.1f} {:>12.1f} {:>12} {:>8}'.format(
+            name, int(total['calls']), total['wall_ms'], total['cpu_ms'],
+            int(total['bytes']) if 'bytes' in total else '',
+            int(total['pages']) if 'pages' in total else ''), file=out)
+    print(file=out)
+
+def run(main):
+    """Runs a script's `main`, profiling it if `--profile` was passed.
+
+    Every script calls this instead of calling `main` directly, e.g.
+    `if __name__ == '__main__': profiling.run(main)`.
+    """
+    global enabled, trace_dir
+
+    trace_file = None
+    for arg in list(sys.argv[1:]):
+        if arg == '--profile' or arg.startswith('--profile='):
+            sys.argv.remove(arg)
+            trace_file = arg.partition('=')[2] or DEFAULT_TRACE_FILE
+    if trace_file is None:
+        return main()
+
+    # Only needed when profiling.
+    import shutil
+    import tempfile
+    trace_dir = tempfile.mkdtemp(prefix='kesem-profile-')
+    os.environ[TRACE_DIR_VARIABLE] = trace_dir
+    enabled = True
+    try:
+        with span(os.path.basename(sys.argv[0])):
+            return main()
+    finally:
+        flush()
+        collected = collect_events()
+        shutil.rmtree(trace_dir)
+        # Stop profiling, in case this process goes on to run another script
+        # (see kesem.py).
+        del os.environ[TRACE_DIR_VARIABLE]
+        (enabled, trace_dir) = (False, None)
+        print_summary(collected)
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': collected, 'displayTimeUnit': 'ms'}, f)
+        print('Saved profile trace to {}'.format(trace_file))
@@ -0,0 +1,203 @@
+"""This script gathers every reader's scores into one ranked table for
+deliberations, `AppReading/deliberation_table.csv`.
+
+Before running it, download each reader's score sheet from Google Sheets (as
+CSV) into their folder, e.g. `AppReading/Jane Doe/Jane Doe Score Sheet.csv`.
+It's fine if Google tacks something onto the file name (" - Sheet1.csv"); the
+newest matching file is used. Run it again whenever more sheets come back.
+
+Readers grade differently -- some give everyone 4s, others rarely go above a
+3 -- so besides plain averages, each score is compared to that reader's other
+scores with a z-score (how many standard deviations above or below their
+average it is). Applicants are ranked by their average post-reference
+z-score, then their average pre-special sauce z-score.
+"""
+from __future__ import print_function
+from collections import OrderedDict
+import argparse
+import csv
+import math
+import os
+import assign_applicant_ids
+import checkpoint
+import profiling
+
+DELIBERATION_TABLE = os.path.join('AppReading', 'deliberation_table.csv')
+
+SCORE_SHEET = ' Score Sheet'
+MIN_SCORE = 1
+MAX_SCORE = 5
+
+def find_score_sheets():
+    """Maps each reader (with a folder in AppReading/) to their newest score
+    sheet."""
+    sheets = OrderedDict()
+    for reader in sorted(next(os.walk('AppReading'))[1]):
+        folder = os.path.join('AppReading', reader)
+        paths = [
+            os.path.join(folder, file_name) for file_name in os.listdir(folder)
+            if file_name.startswith(reader + SCORE_SHEET) and file_name.lower().endswith('.csv')
+        ]
+        if paths:
+            sheets[reader] = max(paths, key=os.path.getmtime)
+    return sheets
+
+def load_score_sheet(path):
+    """Returns the rows of a score sheet -- (applicant ID, pre-special sauce
+    score, post-reference score, notes), with None for missing scores -- and
+    a description of each cell that isn't a score."""
+    rows = OrderedDict()  # applicant ID --> row (the last one, if repeated)
+    problems = []
+    with open(path) as f:
+        for (line, row) in enumerate(csv.reader(f), 1):
+            if line == 1 or not row or not row[0].strip():
+                continue  # header or blank row
+            row = row + [''] * (4 - len(row))
+            scores = []
+            for value in row[1:3]:
+                value = value.strip()
+                score = None
+                if value:
+                    try:
+                        score = float(value)
+                    except ValueError:
+                        pass
+                    if score is None or not MIN_SCORE <= score <= MAX_SCORE:
+                        problems.append('row {}: {!r} isn\'t a score from {} to {}'.format(
+                            line, value, MIN_SCORE, MAX_SCORE))
+                        score = None
+                scores.append(score)
+            rows[row[0].strip()] = (row[0].strip(), scores[0], scores[1], row[3].strip())
+    return (list(rows.values()), problems)
+
+def mean(values):
+    return sum(values) / float(len(values)) if values else None
+
+def standard_deviation(values):
+    if len(values) < 2:
+        return None
+    average = mean(values)
+    return math.sqrt(sum((value - average) ** 2 for value in values) / (len(values) - 1))
+
+def z_scores(scores):
+    """Normalizes a reader's scores (None where missing). A reader who gave
+    fewer than two different scores can't tell applicants apart, so their
+    scores all normalize to 0."""
+    values = [score for score in scores if score is not None]
+    (average, deviation) = (mean(values), standard_deviation(values))
+    return [
+        None if score is None else ((score - average) / deviation if deviation else 0.0)
+        for score in scores
+    ]
+
+class ApplicantScores(object):
+    """Every reader's scores for one applicant."""
+
+    def __init__(self, id_):
+        self.id = id_
+        self.pre = []           # raw scores
+        self.post = []
+        self.pre_z = []         # normalized scores
+        self.post_z = []
+        self.changes = []       # post - pre, from readers who gave both
+        self.changes_z = []
+        self.notes = []
+        self.readers = []       # readers who gave any score
+        self.missing = []       # readers who haven't scored this applicant yet
+
+    def add(self, reader, pre, post, pre_z, post_z, notes):
+        if pre is None and post is None:
+            self.missing.append(reader)
+        else:
+            self.readers.append(reader)
+        for (scores, score) in [(self.pre, pre), (self.post, post), (self.pre_z, pre_z), (self.post_z, post_z)]:
+            if score is not None:
+                scores.append(score)
+        if pre is not None and post is not None:
+            self.changes.append(post - pre)
+            self.changes_z.append(post_z - pre_z)
+        if notes:
+            self.notes.append(notes)
+
+    def rank_key(self):
+        # Unscored applicants go last.
+        return tuple(
+            (0, -value) if value is not None else (1, 0)
+            for value in (mean(self.post_z), mean(self.pre_z))) + (int(self.id) if self.id.isdigit() else 0,)
+
+def aggregate(sheets):
+    """Joins every reader's normalized scores by applicant ID. Returns
+    (applicant ID --> ApplicantScores, reader --> (number of applicants they
+    scored, pre scores, post scores))."""
+    applicants = OrderedDict()
+    reader_scores = OrderedDict()
+    for (reader, rows) in sheets.items():
+        (ids, pre, post, notes) = [list(column) for column in zip(*rows)] if rows else ([], [], [], [])
+        for (id_, scores) in zip(ids, zip(pre, post, z_scores(pre), z_scores(post), notes)):
+            if id_ not in applicants:
+                applicants[id_] = ApplicantScores(id_)
+            applicants[id_].add(reader, *scores)
+        reader_scores[reader] = (
+            sum(1 for scores in zip(pre, post) if scores != (None, None)),
+            [score for score in pre if score is not None],
+            [score for score in post if score is not None])
+    return (applicants, reader_scores)
+
+def format_number(value):
+    return '' if value is None else '{:.2f}'.format(value)
+
+def write_deliberation_table(applicants, names=None):
+    """Writes applicants, best first. `names` (applicant ID --> name) adds a
+    column with applicants' names."""
+    ranked = sorted(applicants.values(), key=ApplicantScores.rank_key)
+    with checkpoint.atomic_output(DELIBERATION_TABLE) as temp_path:
+        with open(temp_path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                ['Rank', 'Applicant ID'] + (['Name'] if names is not None else []) + [
+                'Readers', 'PRE- Special Sauce Score', 'POST- Reference Score', 'Change',
+                'PRE- Special Sauce (normalized)', 'POST- Reference (normalized)', 'Change (normalized)',
+                'Missing Scores From', 'Notes'])
+            for (rank, applicant) in enumerate(ranked, 1):
+                writer.writerow(
+                    [rank, applicant.id] + ([names.get(applicant.id, '')] if names is not None else []) + [
+                    len(applicant.readers)] + [
+                    format_number(mean(scores)) for scores in (
+                        applicant.pre, applicant.post, applicant.changes,
+                        applicant.pre_z, applicant.post_z, applicant.changes_z)] + [
+                    ', '.join(applicant.missing), ' | '.join(applicant.notes)])
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Rank applicants by their (normalized) reader scores.')
+    parser.add_argument('--names', action='store_true',
+            help='include applicant names in the table (leave them out for anonymous deliberations)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    sheets = OrderedDict()
+    for (reader, path) in find_score_sheets().items():
+        (sheets[reader], problems) = load_score_sheet(path)
+        for problem in problems:
+            print('{}: {} (ignored)'.format(path, problem))
+    if not sheets:
+        print('No score sheets found. Download them into each reader\'s folder in AppReading/ first.')
+        return
+
+    (applicants, reader_scores) = aggregate(sheets)
+    for (reader, (scored, pre, post)) in reader_scores.items():
+        print('{}: {} scored, PRE- averages {} (sd {}), POST- averages {} (sd {})'.format(
+            reader, scored,
+            format_number(mean(pre)), format_number(standard_deviation(pre)),
+            format_number(mean(post)), format_number(standard_deviation(post))))
+
+    names = None
+    if args.names:
+        names = dict((id_, name) for (name, id_) in assign_applicant_ids.load_applicant_ids().items())
+    write_deliberation_table(applicants, names)
+    unscored = sum(1 for applicant in applicants.values() if not applicant.pre and not applicant.post)
+    print('Ranked {} applicants from {} score sheets ({} not scored yet) in {}'.format(
+        len(applicants), len(sheets), unscored, DELIBERATION_TABLE))
+
+if __name__ == '__main__':
+    profiling.run(main)
@@ -1,18 +1,30 @@
 from __future__ import print_function
+import argparse
 import csv
 import os
 import app_reader_folder
+import checkpoint
+import profiling
+import wufoo_entry_loader
 
 def load_applicant_id2name():
-    with open('applicant_ids.csv') as f:
+    with open(os.path.join('AppReading', 'applicant_ids.csv')) as f:
         reader = csv.reader(f)
         return dict((row[1], row[0]) for row in reader)
 
-def redo_reader_packets():
+def redo_reader_packets(force=False):
+    """Remakes each reader's packet from their score sheet, skipping packets
+    whose applicants, apps and references haven't changed (unless `force`)."""
     id2name = load_applicant_id2name()
+    fingerprints = wufoo_entry_loader.current_fingerprints()
+    journal = checkpoint.Journal(app_reader_folder.PACKET_JOURNAL_FILE)
+    packet_fragments = None  # loaded once we know some packet needs remaking
     readers = next(os.walk('AppReading'))[1]  # names of reader directories
-    for reader in readers:
-        with open(os.path.join('AppReading', reader, '{}ScoreSheet.csv'.format(reader))) as f:
+    for reader in sorted(readers):
+        score_sheet = os.path.join('AppReading', reader, '{} Score Sheet.csv'.format(reader))
+        if not os.path.exists(score_sheet):
+            continue
+        with open(score_sheet) as f:
             csv_reader = csv.reader(f)
             next(csv_reader)
             reader_apps = []
@@ -20,11 +32,28 @@ def redo_reader_packets():
                 id_ = row[0]
                 reader_apps.append((id2name[id_], id_))
 
-        app_reader_folder.AppReaderFolder(reader, reader_apps).make_app_packet()
+        folder = app_reader_folder.AppReaderFolder(reader, reader_apps)
+        inputs = app_reader_folder.packet_inputs(reader, 'Application Packet', reader_apps, fingerprints)
+        if not force and journal.is_done(folder.packet_path(), inputs):
+            print('{}\'s packet is already up to date'.format(reader))
+            continue
+
+        if packet_fragments is None:
+            packet_fragments = app_reader_folder.PacketFragments()
+        folder.packet_fragments = packet_fragments
+        folder.make_app_packet()
+        journal.record(folder.packet_path(), inputs)
+        print('Remade {}\'s packet'.format(reader))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Remake reader packets from their score sheets.')
+    parser.add_argument('--force', action='store_true',
+            help='remake every packet, even those that look up to date')
+    return parser.parse_args()
 
 def main():
-    redo_reader_packets()
+    args = parse_args()
+    redo_reader_packets(args.force)
 
 if __name__ == '__main__':
-    main()
-
+    profiling.run(main)
@@ -0,0 +1,375 @@
+"""This script searches every application and letter of reference for words or
+phrases, e.g. to find applicants who mentioned sign language:
+
+    python search_answers.py "sign language"
+
+Words must all appear (anywhere in the app or reference); quoted words must
+appear together, in order. A word ending in * matches any word starting with
+it (e.g., `lead*`). Use `--question` to only search answers to questions
+containing some text, and `--kind` to only search apps or references. With
+`--question` and no words, lists everyone who answered those questions at all:
+
+    python search_answers.py --kind reference --question reservations
+
+Applicants are listed by ID (see `assign_applicant_ids.py`), never by name.
+
+Searches use an index of every answer saved in `AppReading/.search_index`, so
+they don't have to read the exports. The index is brought up to date first
+whenever the exports (or applicant IDs) changed, re-indexing only the apps and
+references that changed.
+"""
+from __future__ import print_function
+import argparse
+import os
+import pickle
+import re
+import struct
+import zlib
+import assign_applicant_ids
+import checkpoint
+import profiling
+import wufoo_entry_loader
+
+INDEX_FILE = os.path.join('AppReading', '.search_index')
+
+# Bump this whenever the index layout (or tokenizing) changes.
+INDEX_VERSION = 2
+
+KINDS = ['app', 'reference']
+
+QUESTIONS = {
+    'app': [question for (question, _) in wufoo_entry_loader.APP_FIELDS['questions'].questions],
+    'reference': [question for (question, _) in wufoo_entry_loader.REFERENCE_FIELDS['questions'].questions],
+}
+
+# Files the index is built from, checked before every search.
+SOURCES = [
+    wufoo_entry_loader.APPS_FILE,
+    wufoo_entry_loader.REFERENCES_FILE,
+    assign_applicant_ids.APPLICANT_IDS_FILE,
+]
+
+# Where each word appears is packed into one number: the question (answer)
+# it's in, and its position in that answer.
+POSITION_BITS = 16
+MAX_POSITION = (1 << POSITION_BITS) - 1
+
+# Words, including ones with apostrophes (e.g., "don't").
+WORD_PATTERN = re.compile(r"[^\W_]+(?:'[^\W_]+)*", re.UNICODE)
+
+def tokenize(text):
+    if isinstance(text, bytes):  # python 2 reads the exports (and arguments) as UTF-8 bytes
+        text = text.decode('utf-8', 'replace')
+    return WORD_PATTERN.findall(text.lower().replace(u'\u2019', u"'"))
+
+def source_stats():
+    stats = {}
+    for path in SOURCES:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats[path] = (stat.st_size, stat.st_mtime)
+    return stats
+
+class SearchIndex(object):
+    """Which answers each word appears in, and where.
+
+    On disk, the index is a header (the length of what follows), a pickled
+    dict of everything but the postings (see `meta`), then each word's
+    postings pickled (and compressed) separately, so a search only reads the
+    words it needs.
+    A word's postings map documents (numbered apps and references) to the
+    packed positions (see POSITION_BITS) of the word in them.
+    """
+
+    HEADER = struct.Struct('>Q')
+
+    def __init__(self, meta, postings_file=None, postings_start=0, postings=None):
+        self.meta = meta
+        # Every document indexed: number --> (kind, applicant ID, fingerprint,
+        # bitmask of questions answered).
+        self.documents = meta['documents']
+        self.terms = meta['terms']  # word --> (offset, length) of its postings
+        self.postings_file = postings_file
+        self.postings_start = postings_start
+        self.postings = postings  # word --> postings, when all are loaded
+
+    @classmethod
+    def empty(cls):
+        meta = {
+            'version': INDEX_VERSION,
+            'questions': QUESTIONS,
+            'sources': {},
+            'documents': {},
+            'next_document': 0,
+            'terms': {},
+        }
+        return cls(meta, postings={})
+
+    @classmethod
+    def load(cls, load_postings=False):
+        """Loads the index (or returns None if it's missing or out of date).
+        Postings are read as needed, unless `load_postings`."""
+        try:
+            f = open(INDEX_FILE, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            (meta_size,) = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            meta = pickle.loads(f.read(meta_size))
+            if meta['version'] != INDEX_VERSION or meta['questions'] != QUESTIONS:
+                f.close()
+                return None
+            index = cls(meta, postings_file=f, postings_start=cls.HEADER.size + meta_size)
+            if load_postings:
+                index.postings = dict((term, index.read_postings(term)) for term in index.terms)
+                index.close()
+        except Exception:
+            f.close()
+            return None  # unreadable -- it's rebuilt from scratch
+        return index
+
+    def close(self):
+        if self.postings_file is not None:
+            self.postings_file.close()
+            self.postings_file = None
+
+    def read_postings(self, term):
+        if self.postings is not None:
+            return self.postings.get(term, {})
+        if term not in self.terms:
+            return {}
+        (offset, length) = self.terms[term]
+        self.postings_file.seek(self.postings_start + offset)
+        return pickle.loads(zlib.decompress(self.postings_file.read(length)))
+
+    def expand(self, term):
+        """Words matching a query word (several, for words ending in *)."""
+        if not term.endswith('*'):
+            return [term]
+        prefix = term[:-1]
+        return [word for word in self.terms if word.startswith(prefix)]
+
+    def remove(self, docs):
+        if not docs:
+            return
+        for doc in docs:
+            del self.documents[doc]
+        for (term, postings) in list(self.postings.items()):
+            for doc in docs.intersection(postings):
+                del postings[doc]
+            if not postings:
+                del self.postings[term]
+
+    def add(self, kind, id_, fingerprint, questions):
+        doc = self.meta['next_document']
+        self.meta['next_document'] += 1
+        answered = 0
+        for (question_index, (_, answer)) in enumerate(questions):
+            words = tokenize(answer)
+            if words:
+                answered |= 1 << question_index
+            for (position, word) in enumerate(words[:MAX_POSITION + 1]):
+                self.postings.setdefault(word, {}).setdefault(doc, []).append(
+                    (question_index << POSITION_BITS) | position)
+        self.documents[doc] = (kind, id_, fingerprint, answered)
+
+    def save(self):
+        """Saves the index. If postings weren't loaded (see `load`), they're
+        copied over as they are."""
+        blobs = []
+        if self.postings is not None:
+            terms = {}
+            offset = 0
+            for term in sorted(self.postings.keys()):
+                blob = zlib.compress(pickle.dumps(self.postings[term], protocol=2), 1)
+                terms[term] = (offset, len(blob))
+                blobs.append(blob)
+                offset += len(blob)
+            self.meta['terms'] = self.terms = terms
+
+        meta = pickle.dumps(self.meta, protocol=2)
+        with checkpoint.atomic_output(INDEX_FILE) as temp_path:
+            with open(temp_path, 'wb') as f:
+                f.write(self.HEADER.pack(len(meta)))
+                f.write(meta)
+                if self.postings is None:
+                    self.postings_file.seek(self.postings_start)
+                    for chunk in iter(lambda: self.postings_file.read(1 << 20), b''):
+                        f.write(chunk)
+                for blob in blobs:
+                    f.write(blob)
+            # Windows can't replace a file that's still open.
+            reopen = self.postings_file is not None
+            self.close()
+        if reopen:
+            self.postings_file = open(INDEX_FILE, 'rb')
+            self.postings_start = self.HEADER.size + len(meta)
+
+def current_documents():
+    """Returns {(kind, applicant ID): (fingerprint, questions)} for every app
+    and reference in the exports. Entries without an applicant ID (e.g.,
+    references with no matching app) are left out."""
+    applicant_ids = assign_applicant_ids.load_applicant_ids()
+    apps = wufoo_entry_loader.load_apps(fields=['full_name', 'questions'])
+    references = wufoo_entry_loader.load_references(fields=['applicant_full_name', 'questions'])
+
+    documents = {}
+    for (kind, entries, name_field) in [('app', apps, 'full_name'), ('reference', references, 'applicant_full_name')]:
+        fingerprints = wufoo_entry_loader.fingerprint_entries(entries, name_field)
+        for entry in entries:
+            name = entry[name_field]
+            key = (kind, applicant_ids.get(name))
+            if key[1] is not None and key not in documents:
+                documents[key] = (fingerprints[name], entry['questions'])
+    return documents
+
+def find_changes(index, current):
+    """Returns (documents to remove, keys of documents to index) to bring
+    `index` up to date with `current` (see `current_documents`)."""
+    indexed = dict(((kind, id_), (doc, fingerprint))
+                   for (doc, (kind, id_, fingerprint, _)) in index.documents.items())
+    stale = set(
+        doc for (key, (doc, fingerprint)) in indexed.items()
+        if key not in current or current[key][0] != fingerprint)
+    changed = [
+        key for key in sorted(current.keys())
+        if key not in indexed or indexed[key][1] != current[key][0]]
+    return (stale, changed)
+
+@profiling.timed('search_answers.update_index')
+def update_index(index=None):
+    """Brings the index up to date with the exports, re-indexing only apps and
+    references that are new or changed, and returns (index, documents
+    re-indexed, documents removed).
+
+    Postings are only loaded (and rewritten) if something needs re-indexing.
+    """
+    sources = source_stats()
+    current = current_documents()
+    if index is None:
+        index = SearchIndex.load() or SearchIndex.empty()
+
+    (stale, changed) = find_changes(index, current)
+    if (stale or changed) and index.postings is None:
+        index.close()
+        index = SearchIndex.load(load_postings=True) or SearchIndex.empty()
+        (stale, changed) = find_changes(index, current)
+
+    index.remove(stale)
+    for key in changed:
+        (fingerprint, questions) = current[key]
+        index.add(key[0], key[1], fingerprint, questions)
+
+    index.meta['sources'] = sources
+    index.save()
+    return (index, len(changed), len(stale))
+
+def load_current_index():
+    """Loads the index, updating it first if the exports changed since it was
+    built."""
+    index = SearchIndex.load()
+    if index is None or index.meta['sources'] != source_stats():
+        print('Updating the search index...')
+        (index, added, _) = update_index(index)
+        print('Indexed {} new or changed apps and references.'.format(added))
+    return index
+
+def parse_query(args):
+    """Splits query arguments into parts, each a list of words which must
+    appear together (a quoted phrase) or a single word."""
+    query = []
+    for arg in args:
+        part = []
+        for word in arg.split():
+            tokens = tokenize(word)
+            if tokens and word.endswith('*'):
+                tokens[-1] += '*'
+            part.extend(tokens)
+        if part:
+            query.append(part)
+    return query
+
+@profiling.timed('search_answers.search')
+def search(index, query, kinds=KINDS, question=None):
+    """Returns {doc: set of question indexes matched} for documents matching
+    every part of `query` (see `parse_query`), in the given question (by
+    text) if any."""
+    allowed = {}  # kind --> bitmask of questions to search
+    for kind in kinds:
+        allowed[kind] = 0
+        for (i, text) in enumerate(QUESTIONS[kind]):
+            if question is None or question.lower() in text.lower():
+                allowed[kind] |= 1 << i
+
+    if not query:
+        return dict(
+            (doc, set(i for i in range(len(QUESTIONS[kind])) if answered & allowed.get(kind, 0) & (1 << i)))
+            for (doc, (kind, _, _, answered)) in index.documents.items()
+            if answered & allowed.get(kind, 0))
+
+    matches = None
+    for part in query:
+        # doc --> packed positions where the part starts
+        starts = None
+        for (offset, word) in enumerate(part):
+            positions = {}
+            for term in index.expand(word):
+                for (doc, packed) in index.read_postings(term).items():
+                    scope = allowed.get(index.documents[doc][0], 0)
+                    if scope:
+                        positions.setdefault(doc, set()).update(
+                            p - offset for p in packed if scope >> (p >> POSITION_BITS) & 1)
+            if starts is None:
+                starts = positions
+            else:
+                starts = dict((doc, starts[doc] & positions[doc]) for doc in starts if doc in positions)
+            starts = dict((doc, found) for (doc, found) in starts.items() if found)
+        found = dict((doc, set(p >> POSITION_BITS for p in packed)) for (doc, packed) in (starts or {}).items())
+        if matches is None:
+            matches = found
+        else:
+            matches = dict((doc, matches[doc] | found[doc]) for doc in matches if doc in found)
+    return matches or {}
+
+def describe(kind, id_):
+    return ('Applicant #{}' if kind == 'app' else 'Reference for Applicant #{}').format(id_)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Search every application and letter of reference.')
+    parser.add_argument('words', nargs='*',
+            help='words (or "quoted phrases") that must all appear; end a word with * to match prefixes')
+    parser.add_argument('--question', default=None,
+            help='only search answers to questions containing this text')
+    parser.add_argument('--kind', choices=KINDS, default=None,
+            help='only search apps or references (default: both)')
+    parser.add_argument('--update', action='store_true',
+            help='only bring the index up to date, without searching')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.update:
+        (_, added, removed) = update_index()
+        print('Indexed {} new or changed apps and references ({} removed or replaced).'.format(added, removed))
+        return
+    if not args.words and args.question is None:
+        print('Give some words to search for, or a --question to list answers to.')
+        return
+
+    index = load_current_index()
+    kinds = [args.kind] if args.kind else KINDS
+    matches = search(index, parse_query(args.words), kinds, args.question)
+    index.close()
+
+    results = sorted(
+        (KINDS.index(index.documents[doc][0]), int(index.documents[doc][1]), doc)
+        for doc in matches)
+    print('{} match{}'.format(len(results), '' if len(results) == 1 else 'es'))
+    for (_, _, doc) in results:
+        (kind, id_, _, _) = index.documents[doc]
+        print(describe(kind, id_))
+        for i in sorted(matches[doc]):
+            print('    {}'.format(QUESTIONS[kind][i]))
+
+if __name__ == '__main__':
+    profiling.run(main)
@@ -8,8 +8,41 @@ Some general terms and abstractions used in this file...
              entries (pythonic representations of these submissions)
  """
 
+import checkpoint
 import csv
+import datetime
+import hashlib
+from collections import OrderedDict, defaultdict
+from operator import itemgetter
 import os
+import pickle
+import profiling
+import sys
+import types
+import zlib
+
+try:
+    intern = sys.intern
+except AttributeError:  # python 2, where intern is a builtin
+    pass
+
+# Bump this whenever the snapshot layout changes.
+CACHE_VERSION = 4
+
+# Formats Wufoo has used for submission times.
+SUBMISSION_TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %I:%M:%S %p', '%Y-%m-%d %H:%M']
+
+# Fingerprints of the entries the pipeline last processed, used to find late
+# (new or changed) entries. See `find_late_entries`.
+PROCESSED_ENTRIES_FILE = os.path.join('AppReading', 'processed_entries.csv')
+
+# csv file name --> snapshot already loaded by this process
+loaded_snapshots = {}
+
+# Set by processes that run many commands (e.g., `kesem.py`'s shell). Then
+# `iter_*` and `scan_*` read entries from the snapshot too, so every command
+# after the first gets them from memory instead of parsing the CSV again.
+keep_entries_loaded = False
 
 def normalize(name):
     return ' '.join(name.strip().lower().split())
@@ -17,107 +50,720 @@ def normalize(name):
 def make_name(first_name, last_name):
     return normalize(first_name) + ' ' + normalize(last_name)
 
+# Wufoo sets this column to 1 for entries that were actually submitted. It's
+# always the last column.
+COMPLETION_STATUS = 'Completion Status'
+
+# Set (to anything) to read a column from the position it has been in on past
+# forms when no column has its header (see `find_columns`). It's off by default,
+# since after a form change the old position may hold a different question. Set
+# in the environment, so worker processes see it too.
+USUAL_POSITIONS_VARIABLE = 'KESEM_USUAL_POSITIONS'
+read_usual_positions = bool(os.environ.get(USUAL_POSITIONS_VARIABLE))
+
+# csv file name --> headers last read from their usual position
+guessed_columns = {}
+
+# csv file names we've already warned about reading columns by position
+warned_fallbacks = set()
+
+class MissingColumnsError(Exception):
+    """Raised when a CSV file lacks columns a field needs (usually because the
+    Wufoo form changed). `positioned` are the missing columns that have a
+    usual position (see `find_columns`)."""
+
+    def __init__(self, csv_file_name, missing, positioned=()):
+        self.csv_file_name = csv_file_name
+        self.missing = missing
+        message = '{} has no {} column{}. If the Wufoo form changed, update the field map in wufoo_entry_loader.py.'.format(
+            csv_file_name,
+            ', '.join(repr(column) for column in missing),
+            's' if len(missing) > 1 else '')
+        if positioned and len(positioned) == len(missing):
+            message += ' (If you\'re sure the columns haven\'t moved, set {}=1 to read {} usual position.)'.format(
+                USUAL_POSITIONS_VARIABLE, 'each from its' if len(missing) > 1 else 'it from its')
+        super(MissingColumnsError, self).__init__(message)
+
+class Column(object):
+    """A field holding one column's value, normalized unless `raw` is set.
+    `occurrence` picks among columns sharing a header (0 for the first).
+    `index`, if given, is where the column has been in past exports, which we
+    can fall back to if no column has the header (see `find_columns`)."""
+
+    def __init__(self, header, raw=False, occurrence=0, index=None):
+        self.header = header
+        self.raw = raw
+        self.occurrence = occurrence
+        self.index = index
+
+    def columns(self):
+        return [(self.header, self.occurrence)]
+
+    def fallback_indexes(self):
+        return {} if self.index is None else {(self.header, self.occurrence): self.index}
+
+class FullName(object):
+    """A field holding normalized first and last names joined by a space (see
+    `make_name`). `indexes` are the columns' usual (first, last) indexes."""
+
+    def __init__(self, first_name_header, last_name_header, indexes=(None, None)):
+        self.first_name = Column(first_name_header, index=indexes[0])
+        self.last_name = Column(last_name_header, index=indexes[1])
+
+    def columns(self):
+        return self.first_name.columns() + self.last_name.columns()
+
+    def fallback_indexes(self):
+        return dict(list(self.first_name.fallback_indexes().items()) + list(self.last_name.fallback_indexes().items()))
+
+class Questions(object):
+    """A field holding a (question, answer) pair for each question given.
+    Questions are given by header, or as a (question, header) pair when PDFs
+    should show something other than the header. Repeated headers (e.g.,
+    several "Elaborate" columns) refer to the columns with that header in
+    order. `indexes`, if given, are the questions' usual column indexes."""
+
+    def __init__(self, questions, indexes=None):
+        self.questions = [
+            question if isinstance(question, tuple) else (question, question)
+            for question in questions
+        ]
+        self.indexes = None if indexes is None else list(indexes)
+
+    def columns(self):
+        seen = defaultdict(int)
+        columns = []
+        for (_, header) in self.questions:
+            columns.append((header, seen[header]))
+            seen[header] += 1
+        return columns
+
+    def fallback_indexes(self):
+        return {} if self.indexes is None else dict(zip(self.columns(), self.indexes))
+
+class EntrySchema(object):
+    """The layout of entries loaded with the same fields. Question text lives
+    here, once, instead of in every entry."""
+
+    def __init__(self, fields, questions):
+        self.fields = tuple(fields)
+        self.questions = questions  # field --> tuple of question text, for Questions fields
+        self.slots = {}  # field --> position (or slice, for Questions fields) in an entry's data
+        size = 0
+        for field in self.fields:
+            if field in questions:
+                self.slots[field] = slice(size, size + len(questions[field]))
+                size += len(questions[field])
+            else:
+                self.slots[field] = size
+                size += 1
+        self.projections = {}
+
+    def project(self, fields):
+        """Returns the schema of entries with just `fields`, and a function
+        picking their data out of an entry's data."""
+        fields = tuple(fields)
+        if fields not in self.projections:
+            schema = EntrySchema(fields, dict(
+                (field, self.questions[field]) for field in fields if field in self.questions))
+            positions = []
+            for field in fields:
+                slot = self.slots[field]
+                positions.extend(range(slot.start, slot.stop) if isinstance(slot, slice) else [slot])
+            fetch = itemgetter(*positions) if len(positions) > 1 else lambda data: (data[positions[0]],)
+            self.projections[fields] = (schema, fetch)
+        return self.projections[fields]
+
+    def __getstate__(self):
+        return (self.fields, self.questions)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+class Entry(object):
+    """A loaded entry, which works like a (read-only) dict from fields to
+    values, e.g. `entry['full_name']`.
+
+    Entries keep their values in one flat tuple (with answers to questions
+    inline) and share everything else with other entries through their
+    schema, so they take a fraction of the memory of a dict. Questions fields
+    are built into lists of (question, answer) pairs when accessed.
+    """
+
+    __slots__ = ('schema', 'data')
+
+    def __init__(self, schema, data):
+        self.schema = schema
+        self.data = data
+
+    def __getitem__(self, field):
+        slot = self.schema.slots[field]
+        if isinstance(slot, slice):
+            return list(zip(self.schema.questions[field], self.data[slot]))
+        return self.data[slot]
+
+    def get(self, field, default=None):
+        return self[field] if field in self.schema.slots else default
+
+    def __contains__(self, field):
+        return field in self.schema.slots
+
+    def __iter__(self):
+        return iter(self.schema.fields)
+
+    def __len__(self):
+        return len(self.schema.fields)
+
+    def keys(self):
+        return list(self.schema.fields)
+
+    def values(self):
+        return [self[field] for field in self.schema.fields]
+
+    def items(self):
+        return [(field, self[field]) for field in self.schema.fields]
+
+    def __eq__(self, other):
+        if isinstance(other, Entry):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Entry({!r})'.format(dict(self.items()))
+
+    def __getstate__(self):
+        return (self.schema, self.data)
+
+    def __setstate__(self, state):
+        (self.schema, self.data) = state
+
+def find_columns(csv_file_name, header, columns, fallback=None):
+    """Maps each (header, occurrence) pair to its column's index, raising
+    MissingColumnsError if any are missing.
+
+    Only if `read_usual_positions` is set, a column with no matching header is
+    read from its index in `fallback` (the (header, occurrence) --> index the
+    field map gives), as long as the file has that column and no other column
+    we're looking for was found there by its header. We warn (once per file)
+    when this happens, since the field map's headers should be fixed to match
+    the export.
+    """
+    fallback = fallback or {}
+    indexes = defaultdict(list)
+    for (i, name) in enumerate(header):
+        indexes[name.strip()].append(i)
+    found = {}
+    unfound = []
+    for (name, occurrence) in columns:
+        if occurrence < len(indexes[name]):
+            found[(name, occurrence)] = indexes[name][occurrence]
+        else:
+            unfound.append((name, occurrence))
+
+    taken = set(found.values())
+    missing = []
+    positioned = []
+    guessed = []
+    for column in unfound:
+        index = fallback.get(column)
+        if index is not None and index < 0:
+            index += len(header)
+        usable = index is not None and 0 <= index < len(header) and index not in taken
+        if usable and read_usual_positions:
+            found[column] = index
+            guessed.append(column[0])
+        elif column[0] not in missing:
+            missing.append(column[0])
+            if usable:
+                positioned.append(column[0])
+    if missing:
+        raise MissingColumnsError(csv_file_name, missing, positioned)
+    if guessed:
+        guessed_columns[csv_file_name] = sorted(set(guessed + guessed_columns.get(csv_file_name, [])))
+        warn_guessed(csv_file_name, guessed_columns[csv_file_name])
+    return found
+
+def warn_guessed(csv_file_name, guessed):
+    if csv_file_name in warned_fallbacks:
+        return
+    warned_fallbacks.add(csv_file_name)
+    sys.stderr.write(
+        '{} has no {} column{}, so we\'re reading {} usual position. If the Wufoo form changed, '
+        'update the field map in wufoo_entry_loader.py.\n'.format(
+            csv_file_name, ', '.join(repr(name) for name in guessed),
+            's' if len(guessed) > 1 else '', 'each from its' if len(guessed) > 1 else 'it from its'))
+
+def compile_extractor(csv_file_name, header, field_map, fields):
+    """Compiles a function turning a row of the CSV file into an `Entry` with
+    the given fields.
+
+    Columns are looked up by header once, here. The compiled function fetches
+    every column it needs with a single `itemgetter` call and normalizes (and
+    interns) each column at most once, however many fields use it.
+    """
+    specs = [field_map[field_name] for field_name in fields]
+    fallback = {}
+    for spec in specs:
+        fallback.update(spec.fallback_indexes())
+    found = find_columns(csv_file_name, header, [column for spec in specs for column in spec.columns()], fallback)
+    indexes = sorted(set(found.values()))
+    value_names = dict((index, 'v{}'.format(index)) for index in indexes)
+    namespace = {'fetch': itemgetter(*indexes), 'normalize': normalize, 'intern': intern, 'Entry': Entry}
+
+    normalized = []
+    def value(column, raw=False):
+        index = found[column]
+        if raw:
+            return value_names[index]
+        if index not in normalized:
+            normalized.append(index)
+        return 'n{}'.format(index)
+
+    expressions = []
+    questions = {}
+    for (field_name, spec) in zip(fields, specs):
+        if isinstance(spec, Column):
+            expressions.append(value(spec.columns()[0], spec.raw))
+        elif isinstance(spec, FullName):
+            expressions.append("intern({} + ' ' + {})".format(
+                value(spec.first_name.columns()[0]), value(spec.last_name.columns()[0])))
+        elif isinstance(spec, Questions):
+            questions[field_name] = tuple(question for (question, _) in spec.questions)
+            expressions.extend(value(column, raw=True) for column in spec.columns())
+        else:
+            raise TypeError('Unknown field type for {}: {!r}'.format(field_name, spec))
+    namespace['schema'] = EntrySchema(fields, questions)
+
+    lines = ['def extract(row):']
+    if indexes:
+        lines.append('    ({},) = fetch(row)'.format(', '.join(value_names[index] for index in indexes))
+                     if len(indexes) > 1 else '    {} = fetch(row)'.format(value_names[indexes[0]]))
+    for index in normalized:
+        lines.append('    n{0} = intern(normalize(v{0}))'.format(index))
+    lines.append('    return Entry(schema, ({},))'.format(', '.join(expressions)))
+    exec('\n'.join(lines), namespace)
+    return namespace['extract']
+
 def load_wufoo_entries(csv_file_name, key,
-        field_map, fields):
+        field_map, fields, use_cache=True):
     """Load apps CSV from exported Wufoo entries.
 
+    When several entries share a key (e.g., someone resubmitted the form), we
+    keep the most recent one (see `dedupe_entries`). The others can be found
+    with `load_superseded_entries`.
+
+    Parsed entries are cached in a snapshot next to the CSV file (see
+    `load_cached_entries`), so repeated loads skip CSV parsing entirely.
+
     Parameters
     ----------
     csv_file_name: str
         the name of the csv file containing Wufoo form entries
-    key: fn(row) --> str
-        the name of the column in the csv file which identifies a particular
-        Wufoo entry
+    key: str or tuple(str)
+        the field (or fields) which identify a particular Wufoo entry
         this is usually a name or email
-    field_map: dict(str, fn)
-        maps fields to their corresponding builder functions, which build the
-        field from the original columns of the Wufoo entries
+    field_map: dict(str, Column or FullName or Questions)
+        maps fields to the columns (named by header) they're built from
+        (it must have a `submission_time` field)
     fields: list(str)
         the fields requested -- all fields in this list should be keys of `field_map`
+        (or None, for all of them)
+    use_cache: bool
+        whether to read and write the parsed-entry snapshot
+
+    """
+    if fields is None:
+        fields = list(field_map.keys())
+    if use_cache:
+        entries = load_cached_entries(csv_file_name, key, field_map)['entries']
+    else:
+        entries = parse_wufoo_entries(csv_file_name, key, field_map)[0]
+    return project(entries, fields)
+
+def load_superseded_entries(csv_file_name, key, field_map, fields):
+    """Returns the entries `load_wufoo_entries` dropped because a later entry
+    had the same key, in the order they were submitted."""
+    if fields is None:
+        fields = list(field_map.keys())
+    return project(load_cached_entries(csv_file_name, key, field_map)['superseded'], fields)
+
+def project(entries, fields):
+    """Entries with just `fields`, sharing data with the given entries (which
+    all have the same schema)."""
+    if not entries:
+        return []
+    (schema, fetch) = entries[0].schema.project(fields)
+    if schema.fields == entries[0].schema.fields:
+        return list(entries)
+    return [Entry(schema, fetch(entry.data)) for entry in entries]
+
+def parse_submission_time(value):
+    for time_format in SUBMISSION_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), time_format)
+        except ValueError:
+            pass
+    return datetime.datetime.min  # unparseable times lose to any real one
+
+def find_superseded(keyed_times):
+    """Takes the (key, submission time) of each entry, in file order, and
+    returns the positions of entries superseded by a later submission with the
+    same key. Ties go to the entry further down the file."""
+    latest = {}  # key --> (submission time, position) of the latest entry so far
+    superseded = set()
+    for (position, (key, submission_time)) in enumerate(keyed_times):
+        order = (parse_submission_time(submission_time), position)
+        if key not in latest:
+            latest[key] = order
+        elif order > latest[key]:
+            superseded.add(latest[key][1])
+            latest[key] = order
+        else:
+            superseded.add(position)
+    return superseded
+
+def key_getter(key):
+    return itemgetter(*key) if isinstance(key, tuple) else itemgetter(key)
+
+def dedupe_entries(entries, key):
+    """Splits entries into (latest, superseded) in a single pass, keeping only
+    the most recent (by `submission_time`) of entries sharing a key."""
+    get_key = key_getter(key)
+    superseded = find_superseded((get_key(entry), entry['submission_time']) for entry in entries)
+    return (
+        [entry for (i, entry) in enumerate(entries) if i not in superseded],
+        [entry for (i, entry) in enumerate(entries) if i in superseded],
+    )
 
+def parse_wufoo_entries(csv_file_name, key, field_map):
+    """Parses every field of every submitted entry, returning (latest,
+    superseded) entries (see `dedupe_entries`)."""
+    with profiling.span('wufoo_entry_loader.parse_csv') as span:
+        if profiling.enabled:
+            span.add(bytes=os.path.getsize(csv_file_name))
+        return dedupe_entries(list(iter_submitted_entries(csv_file_name, field_map, list(field_map.keys()))), key)
+
+def iter_wufoo_entries(csv_file_name, key, field_map, fields=None):
+    """Yields the same entries as `load_wufoo_entries` (with just the requested
+    `fields`) one at a time, straight from the CSV file, so memory use doesn't
+    grow with the size of the entries. Unlike `load_wufoo_entries`, this
+    doesn't use (or write) snapshots.
+
+    To skip superseded entries, we first make a quick pass over just the key
+    and submission time of each entry.
     """
+    if keep_entries_loaded:
+        for entry in load_wufoo_entries(csv_file_name, key, field_map, fields):
+            yield entry
+        return
+
+    if fields is None:
+        fields = list(field_map.keys())
+    key_fields = list(key) if isinstance(key, tuple) else [key]
+    get_key = key_getter(key)
+    superseded = find_superseded(
+        (get_key(entry), entry['submission_time'])
+        for entry in iter_submitted_entries(csv_file_name, field_map, key_fields + ['submission_time']))
+
+    for (i, entry) in enumerate(iter_submitted_entries(csv_file_name, field_map, fields)):
+        if i not in superseded:
+            yield entry
+
+def scan_wufoo_entries(csv_file_name, key, field_map, fields=None):
+    """Returns the same entries as `load_wufoo_entries` (with just the
+    requested `fields`) after a single pass over the CSV file, without using
+    (or writing) snapshots. Entries are held in memory until superseded ones
+    are dropped, so this is best for a few short fields -- e.g., for stats that
+    are recomputed every time the exports change.
+    """
+    if keep_entries_loaded:
+        return load_wufoo_entries(csv_file_name, key, field_map, fields)
+
+    if fields is None:
+        fields = list(field_map.keys())
+    key_fields = list(key) if isinstance(key, tuple) else [key]
+    extra_fields = [field for field in key_fields + ['submission_time'] if field not in fields]
+    entries = dedupe_entries(list(iter_submitted_entries(csv_file_name, field_map, fields + extra_fields)), key)[0]
+    return project(entries, fields)
+
+def iter_submitted_entries(csv_file_name, field_map, fields):
     with open(csv_file_name) as f:
         entry_reader = csv.reader(f)
-        header = next(entry_reader)  # header
+        header = next(entry_reader)
+        extract = compile_extractor(csv_file_name, header, field_map, fields)
+        completed = find_columns(
+            csv_file_name, header, [(COMPLETION_STATUS, 0)], {(COMPLETION_STATUS, 0): -1})[(COMPLETION_STATUS, 0)]
 
-        # We keep the most recent entry based on the identifier.
-        return [
-            build_entry(row, field_map, fields)
-            for row in entry_reader
-            if row[-1] == '1'  # Checks if Wufoo entry was actually submitted]
-        ]
+        for row in entry_reader:
+            if row[completed] == '1':  # Checks if Wufoo entry was actually submitted
+                yield extract(row)
 
-def build_entry(row, field_map, fields):
-    return {
-        field_name: field_map[field_name](row)
-        for field_name in fields
-    }
+def cache_file_name(csv_file_name):
+    (directory, base_name) = os.path.split(csv_file_name)
+    return os.path.join(directory, '.' + base_name + '.cache')
+
+def fingerprint_field_map(field_map):
+    """Hashes each field's definition (and the code behind `normalize`), so
+    editing a `field_map` invalidates snapshots built with the old one."""
+    digest = hashlib.sha1()
+    seen = set()
+
+    def visit(value):
+        if isinstance(value, types.FunctionType):
+            if value in seen:
+                return
+            seen.add(value)
+            visit(value.__code__)
+            for name in value.__code__.co_names:
+                if isinstance(value.__globals__.get(name), types.FunctionType):
+                    visit(value.__globals__[name])
+            for cell in value.__closure__ or ():
+                visit(cell.cell_contents)
+        elif isinstance(value, types.CodeType):
+            digest.update(value.co_code)
+            digest.update(repr(value.co_names).encode('utf-8'))
+            for const in value.co_consts:
+                visit(const)
+        elif isinstance(value, dict):
+            for (k, v) in sorted(value.items(), key=lambda item: repr(item[0])):
+                digest.update(repr(k).encode('utf-8'))
+                visit(v)
+        elif isinstance(value, (Column, FullName, Questions)):
+            digest.update(type(value).__name__.encode('utf-8'))
+            visit(vars(value))
+        else:
+            digest.update(repr(value).encode('utf-8'))
+
+    visit(field_map)
+    visit(normalize)
+    return digest.hexdigest()
 
-def load_apps(fields):
-    APP_QUESTIONS = [
-        ('2nd-3rd Grade (~7-8 years old)', 16),
-        ('4th -5th Grade (~9-10 years old)', 17),
-        ('6th Grade (~11 years old)', 18),
-        ('7th Grade (~12 years old)', 19),
-        ('8th Grade (~13 years old)', 20),
-        ('9th Grade (~14 years old)', 21),
-        ('Outdoor Leadership Program (10th/11th Grade ~15-16 years old)', 22),
-        ('Why are you interested in participating in OLP?', 23), 
-        ('Describe your relevant experience working with children.', 24),
-        ('Describe your experience working at camp.', 25),
-        ('Describe your leadership positions.', 26),
-        ('Describe a favorite childhood memory.', 27),
-        ('What are three things you want us to know about you?', 28),
-        ('What is something you would be excited to teach or facilitate at camp?', 29),
-        ('Why do you want to volunteer your time for Camp Kesem?', 30),
-        ('In what ways would you contribute to the diversity of Kesem\'s community?', 31),
-        ('Special Sauce', 32),
-        ('Additional Info', 33),
-        ('Additional Info Upload (sometimes contains special sauce)', 34),
-    ]
-    fields_map = {
-        'first_name': lambda row: normalize(row[1]),
-        'last_name': lambda row: normalize(row[2]),
-        'full_name': lambda row: make_name(row[1], row[2]),
-        'email': lambda row: normalize(row[9]),
-        'school_year': lambda row: row[7],
-        'gender': lambda row: normalize(row[5]),
-        'submission_time': lambda row: row[37],
-        'questions': lambda row: [(q, row[index]) for (q, index) in APP_QUESTIONS]
+@profiling.timed('wufoo_entry_loader.load')
+def load_cached_entries(csv_file_name, key, field_map):
+    """Loads all fields of `field_map` for every submitted entry, reading
+    them from the snapshot when it is still valid and rebuilding it otherwise.
+    Returns the snapshot, whose 'entries' are the latest entries and whose
+    'superseded' are the rest (see `dedupe_entries`).
+
+    A snapshot is valid when it was built with the same `key`, `field_map`
+    and `read_usual_positions` from a CSV file with the same size and either the same mtime or, failing that,
+    the same content hash. Snapshots are also kept in memory, so loading the
+    same file again in the same process is nearly free.
+    """
+    snapshot_name = cache_file_name(csv_file_name)
+    stat = os.stat(csv_file_name)
+    field_map_hash = fingerprint_field_map(field_map)
+    content_hash = None
+
+    def is_current(snapshot):
+        return snapshot['version'] == CACHE_VERSION and \
+                snapshot['key'] == key and \
+                snapshot['field_map'] == field_map_hash and \
+                snapshot['usual_positions'] == read_usual_positions and \
+                snapshot['size'] == stat.st_size and \
+                snapshot['mtime'] == stat.st_mtime
+
+    snapshot = loaded_snapshots.get(csv_file_name)
+    if snapshot is not None and is_current(snapshot):
+        return snapshot
+
+    try:
+        with open(snapshot_name, 'rb') as f:
+            snapshot = pickle.loads(zlib.decompress(f.read()))
+        if snapshot['version'] == CACHE_VERSION and \
+                snapshot['key'] == key and \
+                snapshot['field_map'] == field_map_hash and \
+                snapshot['usual_positions'] == read_usual_positions and \
+                snapshot['size'] == stat.st_size:
+            if snapshot['mtime'] != stat.st_mtime:
+                content_hash = checkpoint.hash_file(csv_file_name)
+                if snapshot['content'] != content_hash:
+                    raise ValueError('stale snapshot')
+                snapshot['mtime'] = stat.st_mtime
+            if snapshot['guessed']:
+                warn_guessed(csv_file_name, snapshot['guessed'])
+            loaded_snapshots[csv_file_name] = snapshot
+            return snapshot
+    except Exception:
+        pass  # missing, unreadable or stale snapshot -- just rebuild it
+
+    guessed_columns.pop(csv_file_name, None)
+    (entries, superseded) = parse_wufoo_entries(csv_file_name, key, field_map)
+    snapshot = {
+        'version': CACHE_VERSION,
+        'key': key,
+        'field_map': field_map_hash,
+        'usual_positions': read_usual_positions,
+        'guessed': guessed_columns.get(csv_file_name, []),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'content': content_hash or checkpoint.hash_file(csv_file_name),
+        'entries': entries,
+        'superseded': superseded,
     }
-    key = fields_map['email']
-    return load_wufoo_entries(os.path.join('AppReading', 'apps.csv'), key, fields_map, fields)
-
-def load_references(fields):
-    REFERENCE_QUESTIONS = [
-        ('How do they know the applicant?', 7),
-        ('How well does the applicant work with others in a team environment?', 8),
-        ('Elaborate', 9),
-        ('How well does they communicate with peers?', 10),
-        ('Elaborate', 11),
-        ('How well do they manage stressful situations?', 12),
-        ('Elaborate', 13),
-        ('To what extent are they willing to take initiative?', 14),
-        ('Elaborate', 15),
-        ('How good of a listener are they?', 16),
-        ('Elaborate', 17),
-        ('How well can you imagine the applicant engaging with campers?', 18),
-        ('Elaborate', 19),
-        ('How would you rank their energy level?', 20),
-        ('Elaborate', 21),
-        ('Any reservations?', 22),
-        ('Anything else?', 23),
-    ]
-    fields_map = {
-        'reference_first_name': lambda row: normalize(row[1]),
-        'reference_last_name': lambda row: normalize(row[2]),
-        'reference_full_name': lambda row: make_name(row[1], row[2]),
-        'applicant_first_name': lambda row: normalize(row[5]),
-        'applicant_last_name': lambda row: normalize(row[6]),
-        'applicant_full_name': lambda row: make_name(row[5], row[6]),
-        'submission_time': lambda row: row[26],
-        'questions': lambda row: [(q, row[index]) for (q, index) in REFERENCE_QUESTIONS]
+    loaded_snapshots[csv_file_name] = snapshot
+    try:
+        temp_name = snapshot_name + '.tmp'
+        with open(temp_name, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(snapshot, protocol=2)))
+        os.rename(temp_name, snapshot_name)
+    except (IOError, OSError):
+        pass  # caching is best-effort
+
+    return snapshot
+
+# Applicants rank the age groups they'd like to be counselors for.
+GRADE_QUESTIONS = [
+    '2nd-3rd Grade (~7-8 years old)',
+    '4th -5th Grade (~9-10 years old)',
+    '6th Grade (~11 years old)',
+    '7th Grade (~12 years old)',
+    '8th Grade (~13 years old)',
+    '9th Grade (~14 years old)',
+    'Outdoor Leadership Program (10th/11th Grade ~15-16 years old)',
+]
+
+APP_QUESTIONS = GRADE_QUESTIONS + [  # headers, or (question, header) pairs
+    'Why are you interested in participating in OLP?',
+    'Describe your relevant experience working with children.',
+    'Describe your experience working at camp.',
+    'Describe your leadership positions.',
+    'Describe a favorite childhood memory.',
+    'What are three things you want us to know about you?',
+    'What is something you would be excited to teach or facilitate at camp?',
+    'Why do you want to volunteer your time for Camp Kesem?',
+    'In what ways would you contribute to the diversity of Kesem\'s community?',
+    'Special Sauce',
+    'Additional Info',
+    ('Additional Info Upload (sometimes contains special sauce)', 'Additional Info Upload'),
+]
+
+# Headers were checked only against synthetic exports, so each field also
+# gives the column it was read from before fields were looked up by header.
+APP_FIELDS = {
+    'first_name': Column('First Name', index=1),
+    'last_name': Column('Last Name', index=2),
+    'full_name': FullName('First Name', 'Last Name', indexes=(1, 2)),
+    'email': Column('Email', index=9),
+    'school_year': Column('Year in School', raw=True, index=7),
+    'gender': Column('Gender', index=5),
+    'submission_time': Column('Date Created', raw=True, index=37),
+    'grade_preferences': Questions(GRADE_QUESTIONS, indexes=range(16, 23)),
+    'questions': Questions(APP_QUESTIONS, indexes=range(16, 35)),
+}
+
+REFERENCE_QUESTIONS = [  # headers, or (question, header) pairs
+    'How do they know the applicant?',
+    'How well does the applicant work with others in a team environment?',
+    'Elaborate',
+    'How well does they communicate with peers?',
+    'Elaborate',
+    'How well do they manage stressful situations?',
+    'Elaborate',
+    'To what extent are they willing to take initiative?',
+    'Elaborate',
+    'How good of a listener are they?',
+    'Elaborate',
+    'How well can you imagine the applicant engaging with campers?',
+    'Elaborate',
+    'How would you rank their energy level?',
+    'Elaborate',
+    'Any reservations?',
+    'Anything else?',
+]
+
+REFERENCE_FIELDS = {
+    'reference_first_name': Column('First Name', index=1),
+    'reference_last_name': Column('Last Name', index=2),
+    'reference_full_name': FullName('First Name', 'Last Name', indexes=(1, 2)),
+    'applicant_first_name': Column('Applicant First Name', index=5),
+    'applicant_last_name': Column('Applicant Last Name', index=6),
+    'applicant_full_name': FullName('Applicant First Name', 'Applicant Last Name', indexes=(5, 6)),
+    'submission_time': Column('Date Created', raw=True, index=26),
+    'questions': Questions(REFERENCE_QUESTIONS, indexes=range(7, 24)),
+}
+
+APPS_FILE = os.path.join('AppReading', 'apps.csv')
+APP_KEY = 'email'
+
+REFERENCES_FILE = os.path.join('AppReading', 'references.csv')
+REFERENCE_KEY = ('reference_full_name', 'applicant_full_name')
+
+def load_apps(fields=None):
+    return load_wufoo_entries(APPS_FILE, APP_KEY, APP_FIELDS, fields)
+
+def load_references(fields=None):
+    return load_wufoo_entries(REFERENCES_FILE, REFERENCE_KEY, REFERENCE_FIELDS, fields)
+
+def iter_apps(fields=None):
+    return iter_wufoo_entries(APPS_FILE, APP_KEY, APP_FIELDS, fields)
+
+def iter_references(fields=None):
+    return iter_wufoo_entries(REFERENCES_FILE, REFERENCE_KEY, REFERENCE_FIELDS, fields)
+
+def scan_apps(fields=None):
+    return scan_wufoo_entries(APPS_FILE, APP_KEY, APP_FIELDS, fields)
+
+def scan_references(fields=None):
+    return scan_wufoo_entries(REFERENCES_FILE, REFERENCE_KEY, REFERENCE_FIELDS, fields)
+
+def load_superseded_apps(fields=None):
+    return load_superseded_entries(APPS_FILE, APP_KEY, APP_FIELDS, fields)
+
+def load_superseded_references(fields=None):
+    return load_superseded_entries(REFERENCES_FILE, REFERENCE_KEY, REFERENCE_FIELDS, fields)
+
+
+def fingerprint_entries(entries, name_field):
+    """Maps each name to a fingerprint of the first entry with that name, which
+    changes whenever anything in the entry does."""
+    fingerprints = OrderedDict()
+    for entry in entries:
+        if entry[name_field] not in fingerprints:
+            fingerprints[entry[name_field]] = hashlib.sha1(
+                repr(sorted(entry.items())).encode('utf-8')).hexdigest()
+    return fingerprints
+
+def current_fingerprints():
+    """Fingerprints of the apps and references in the current exports, keyed by
+    applicant name. Only fields that end up in PDFs are fingerprinted."""
+    apps = load_apps(fields=['full_name', 'questions'])
+    references = load_references(fields=['applicant_full_name', 'questions'])
+    return {
+        'app': fingerprint_entries(apps, 'full_name'),
+        'reference': fingerprint_entries(references, 'applicant_full_name'),
     }
-    key = lambda row: (fields_map['reference_full_name'](row), fields_map['applicant_full_name'](row))
-    return load_wufoo_entries(os.path.join('AppReading', 'references.csv'), key, fields_map, fields)
 
+def save_processed_fingerprints(fingerprints=None):
+    """Records the given (by default, current) fingerprints as processed."""
+    if fingerprints is None:
+        fingerprints = current_fingerprints()
+    with open(PROCESSED_ENTRIES_FILE, 'w') as f:
+        writer = csv.writer(f)
+        for kind in ('app', 'reference'):
+            for (name, fingerprint) in fingerprints[kind].items():
+                writer.writerow([kind, name, fingerprint])
+
+def load_processed_fingerprints():
+    """Returns the last recorded fingerprints, or None if nothing was recorded."""
+    if not os.path.exists(PROCESSED_ENTRIES_FILE):
+        return None
+    fingerprints = {'app': OrderedDict(), 'reference': OrderedDict()}
+    with open(PROCESSED_ENTRIES_FILE) as f:
+        for (kind, name, fingerprint) in csv.reader(f):
+            fingerprints[kind][name] = fingerprint
+    return fingerprints
+
+def find_late_entries(processed, current):
+    """Returns the names of applicants whose app changed (or is new) and whose
+    reference changed (or is new) since `processed` was recorded."""
+    return tuple(
+        [name for (name, fingerprint) in current[kind].items()
+            if processed[kind].get(name) != fingerprint]
+        for kind in ('app', 'reference')
+    )
@@ -1,21 +1,332 @@
 
+import checkpoint
+from collections import OrderedDict
+import contextlib
 import fpdf
+import fpdf.fpdf
+import fpdf.ttfonts
+import hashlib
 import os
+import pickle
+import profiling
 import re
+import zlib
+
+FONTS = [
+    ('dejavu', os.path.join('fonts', 'DejaVuSansCondensed.ttf')),
+    ('dejavub', os.path.join('fonts', 'DejaVuSansCondensed-Bold.ttf')),
+]
+
+# Parsed font metrics are cached here, keyed by the hash of the font file they
+# came from.
+FONT_CACHE_DIR = os.path.join('fonts', 'cache')
+
+# How many font subsets (and their widths) each process keeps in memory. Most
+# documents' subsets are different, but some (e.g., the bold font, used only
+# for questions) repeat from document to document.
+SUBSET_CACHE_SIZE = 32
+
+# Bump this whenever what we cache for a font's metrics changes.
+FONT_CACHE_VERSION = 2
+
+# Fonts loaded once for this process and copied into every WufooPDF. See
+# `preload_fonts`.
+loaded_fonts = None
+
+# font file name --> hash of its contents
+font_hashes = {}
+
+def hash_font(file_name):
+    if file_name not in font_hashes:
+        with open(file_name, 'rb') as f:
+            font_hashes[file_name] = hashlib.sha1(f.read()).hexdigest()
+    return font_hashes[file_name]
+
+def read_font_cache(name):
+    try:
+        with open(os.path.join(FONT_CACHE_DIR, name), 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None  # missing or unreadable -- the caller rebuilds it
+
+def write_font_cache(name, value):
+    # Several processes may write the same entry at once, so each writes its
+    # own temporary file and atomically renames it into place.
+    try:
+        if not os.path.isdir(FONT_CACHE_DIR):
+            os.makedirs(FONT_CACHE_DIR)
+        path = os.path.join(FONT_CACHE_DIR, name)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=2)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        pass  # caching is best-effort
+
+def load_font(family, file_name):
+    """Returns fpdf's (font, font files) entries for a TTF font, parsing the
+    font file only if its metrics aren't cached yet."""
+    cache_name = '{}-{}-{}.metrics'.format(family, hash_font(file_name), FONT_CACHE_VERSION)
+    cached = read_font_cache(cache_name)
+    if cached is not None:
+        return cached
+
+    # Skip fpdf's own metrics cache, which is never invalidated.
+    cache_mode = fpdf.fpdf.FPDF_CACHE_MODE
+    fpdf.set_global('FPDF_CACHE_MODE', 1)
+    try:
+        pdf = fpdf.FPDF()
+        pdf.add_font(family, '', file_name, uni=True)
+    finally:
+        fpdf.set_global('FPDF_CACHE_MODE', cache_mode)
+    loaded = (pdf.fonts[family], pdf.font_files)
+    write_font_cache(cache_name, loaded)
+    return loaded
+
+def preload_fonts():
+    """Loads FONTS once for this process (e.g., in a worker pool initializer)."""
+    global loaded_fonts
+    if loaded_fonts is None:
+        fonts = {}
+        font_files = {}
+        for (i, (family, file_name)) in enumerate(FONTS):
+            (font, files) = load_font(family, file_name)
+            fonts[family] = dict(font, i=i + 1)
+            font_files.update(files)
+        loaded_fonts = (fonts, font_files)
+    return loaded_fonts
+
+def attach_fonts(pdf):
+    (fonts, font_files) = preload_fonts()
+    # fpdf tracks each document's used characters and object numbers in these
+    # dicts, so every document gets its own copies. Metrics are shared.
+    for (key, font) in fonts.items():
+        pdf.fonts[key] = dict(font, subset=list(font['subset']))
+    for (key, font_file) in font_files.items():
+        pdf.font_files[key] = dict(font_file)
+
+class RecentlyUsed(object):
+    """A cache keeping only the `size` most recently used values."""
+
+    def __init__(self, size):
+        self.size = size
+        self.values = OrderedDict()
+
+    def get(self, key):
+        value = self.values.pop(key, None)
+        if value is not None:
+            self.values[key] = value
+        return value
+
+    def put(self, key, value):
+        self.values.pop(key, None)
+        self.values[key] = value
+        while len(self.values) > self.size:
+            self.values.popitem(last=False)
+
+class CachedTTFontFile(fpdf.ttfonts.TTFontFile):
+    """Reuses recently built font subsets (the characters a document actually
+    uses). fpdf otherwise re-reads the whole font file and rebuilds the subset
+    every time a document is saved."""
+
+    subsets = RecentlyUsed(SUBSET_CACHE_SIZE)  # (font hash, characters) --> (font stream, code to glyph, max unicode)
+
+    def makeSubset(self, file, subset):
+        characters = tuple(sorted(set(subset)))
+        key = (hash_font(file), characters)
+
+        cached = self.subsets.get(key)
+        if cached is None:
+            stream = fpdf.ttfonts.TTFontFile.makeSubset(self, file, list(characters))
+            cached = (stream, self.codeToGlyph, self.maxUni)
+            self.subsets.put(key, cached)
+
+        (stream, self.codeToGlyph, self.maxUni) = cached
+        return stream
+
+class CachedFontFPDF(fpdf.FPDF):
+    """FPDF that reuses recently built font subsets and their glyph
+    widths."""
+
+    widths = RecentlyUsed(SUBSET_CACHE_SIZE)  # (font hash, characters) --> '/W' line of the font's widths
+
+    def _putfonts(self):
+        # fpdf builds font subsets with whatever TTFontFile its module refers
+        # to, so we swap in ours just while this document's fonts are written.
+        original = fpdf.fpdf.TTFontFile
+        fpdf.fpdf.TTFontFile = CachedTTFontFile
+        try:
+            fpdf.FPDF._putfonts(self)
+        finally:
+            fpdf.fpdf.TTFontFile = original
+
+    def _putTTfontwidths(self, font, maxUni):
+        key = (hash_font(font['ttffile']), tuple(sorted(set(font['subset']))))
+        lines = self.widths.get(key)
+        if lines is None:
+            # fpdf checks each of the font's ~65k characters for membership in
+            # the subset, which is far too slow with a list.
+            lines = []
+            self._out = lines.append
+            try:
+                fpdf.FPDF._putTTfontwidths(self, dict(font, subset=set(font['subset'])), maxUni)
+            finally:
+                del self._out
+            self.widths.put(key, lines)
+        for line in lines:
+            self._out(line)
+
+class FileBuffer(object):
+    """Stands in for fpdf's output buffer (a string), writing to a file
+    instead. fpdf only ever appends to its buffer and takes its length (to
+    record where each object starts)."""
+
+    def __init__(self, f):
+        self.file = f
+        self.size = 0
+
+    def __iadd__(self, text):
+        # fpdf keeps binary data (e.g., compressed streams) as latin-1 text.
+        data = text if isinstance(text, bytes) else text.encode('latin1')
+        self.file.write(data)
+        self.size += len(data)
+        return self
+
+    def __len__(self):
+        return self.size
+
+class StreamingFPDF(CachedFontFPDF):
+    """FPDF that writes each page to a file as soon as it's finished, instead
+    of keeping the whole document in memory until it's saved. Fonts, which
+    depend on the characters used by every page, are written once at the end.
+
+    Objects are numbered just like fpdf numbers them (pages first, then
+    fonts), so the file comes out the same as if fpdf had written it.
+    """
+
+    def __init__(self, f, *args, **kwargs):
+        CachedFontFPDF.__init__(self, *args, **kwargs)
+        self.buffer = FileBuffer(f)
+        CachedFontFPDF._putheader(self)
+        self.pages_written = 0
+
+    def _putheader(self):
+        pass  # already written
+
+    def _beginpage(self, orientation):
+        # Every page before this one is finished.
+        self.write_pages(self.page)
+        CachedFontFPDF._beginpage(self, orientation)
+
+    def write_pages(self, last_page):
+        """Writes finished pages up to `last_page` and frees their content."""
+        (state, self.state) = (self.state, 1)  # fpdf writes to the current page in state 2
+        try:
+            filter = '/Filter /FlateDecode ' if self.compress else ''
+            for n in range(self.pages_written + 1, last_page + 1):
+                self._newobj()
+                self._out('<</Type /Page')
+                self._out('/Parent 1 0 R')
+                self._out('/Resources 2 0 R')
+                if self.pdf_version > '1.3':
+                    self._out('/Group <</Type /Group /S /Transparency /CS /DeviceRGB>>')
+                self._out('/Contents ' + str(self.n + 1) + ' 0 R>>')
+                self._out('endobj')
+
+                content = self.pages[n]
+                if self.compress:
+                    content = zlib.compress(content if isinstance(content, bytes) else content.encode('latin1'))
+                self._newobj()
+                self._out('<<' + filter + '/Length ' + str(len(content)) + '>>')
+                self._putstream(content)
+                self._out('endobj')
+                del self.pages[n]
+            self.pages_written = max(self.pages_written, last_page)
+        finally:
+            self.state = state
+
+    def _putpages(self):
+        self.write_pages(self.page)
+        self.offsets[1] = len(self.buffer)
+        self._out('1 0 obj')
+        self._out('<</Type /Pages')
+        self._out('/Kids [' + ''.join(str(3 + 2 * i) + ' 0 R ' for i in range(self.page)) + ']')
+        self._out('/Count ' + str(self.page))
+        self._out('/MediaBox [0 0 %.2f %.2f]' % (self.fw_pt, self.fh_pt))
+        self._out('>>')
+        self._out('endobj')
+
+class PageFragment(object):
+    """Pages already laid out by a WufooPDF, along with the characters they use
+    from each font. Appending a fragment to another WufooPDF copies its pages
+    as-is instead of laying them out again."""
+
+    def __init__(self, pages, subsets):
+        self.pages = pages      # page content streams, in order
+        self.subsets = subsets  # font key --> set of characters used
 
 class WufooPDF(object):
-    def __init__(self):
-        self.pdf = fpdf.FPDF(format='letter')
-        self.pdf.add_font('dejavu', '', 'fonts/DejaVuSansCondensed.ttf', uni=True)
-        self.pdf.add_font('dejavub', '', 'fonts/DejaVuSansCondensed-Bold.ttf', uni=True)
+    def __init__(self, stream_to=None):
+        """Pages are kept in memory until `save`, unless `stream_to` (a file
+        opened for writing bytes) is given -- see `streaming_pdf`."""
+        if stream_to is None:
+            self.pdf = CachedFontFPDF(format='letter')
+        else:
+            self.pdf = StreamingFPDF(stream_to, format='letter')
+        attach_fonts(self.pdf)
 
     def append(self, entry, title=''):
-        self.pdf.add_page()
-        self.add_title(title)
-        self.add_questions(entry)
+        with profiling.span('WufooPDF.layout') as span:
+            first_page = self.pdf.page
+            self.pdf.add_page()
+            self.add_title(title)
+            self.add_questions(entry)
+            span.add(pages=self.pdf.page - first_page)
+
+    def render_fragment(self, render):
+        """Lays out pages with `render(self)` and returns them as a PageFragment.
+
+        `render` should start on a new page (e.g., by calling `append` or
+        `add_cover_page`), so the fragment doesn't share a page with anything
+        rendered before it.
+        """
+        # fpdf starts each page in the last font set, and skips setting a font
+        # that is already current. Forget it, so a fragment's pages are the same
+        # whatever was rendered before it (as if it began a new document).
+        self.pdf.font_family = ''
+        first_page = self.pdf.page + 1
+        subset_sizes = dict((key, len(font['subset'])) for (key, font) in self.pdf.fonts.items())
+        render(self)
+        pages = [self.pdf.pages[n] for n in range(first_page, self.pdf.page + 1)]
+        subsets = dict(
+            (key, set(font['subset'][subset_sizes.get(key, 0):]))
+            for (key, font) in self.pdf.fonts.items()
+        )
+        return PageFragment(pages, subsets)
+
+    def append_fragment(self, fragment):
+        with profiling.span('WufooPDF.append_fragment') as span:
+            for page in fragment.pages:
+                self.pdf.add_page()
+                self.pdf.pages[self.pdf.page] = page
+            for (key, chars) in fragment.subsets.items():
+                subset = self.pdf.fonts[key]['subset']
+                subset.extend(sorted(chars.difference(subset)))
+            span.add(pages=len(fragment.pages))
 
     def save(self, out):
-        self.pdf.output(out)
+        """Writes the PDF to `out`, all at once (see `checkpoint.atomic_output`)."""
+        with profiling.span('WufooPDF.save') as span:
+            with checkpoint.atomic_output(out) as temp_out:
+                self.pdf.output(temp_out, 'F')
+            if profiling.enabled:
+                span.add(pages=self.pdf.page, bytes=os.path.getsize(out))
+
+    def finish(self):
+        """Writes the rest of a PDF made with `stream_to`."""
+        with profiling.span('WufooPDF.finish') as span:
+            self.pdf.close()
+            span.add(pages=self.pdf.page, bytes=len(self.pdf.buffer))
 
     def add_questions(self, questions):
         for (i, (question, answer)) in enumerate(questions):
@@ -60,10 +371,13 @@ class WufooPDF(object):
         self.pdf.multi_cell(0, 10, txt=txt, align='L')
 
     def add_cover_page(self, txt):
-        self.pdf.add_page()
-        self.pdf.set_font('dejavub', size=22)
-        self.pdf.ln(110)
-        self.pdf.multi_cell(0, 10, txt=txt, align='C')
+        with profiling.span('WufooPDF.layout') as span:
+            first_page = self.pdf.page
+            self.pdf.add_page()
+            self.pdf.set_font('dejavub', size=22)
+            self.pdf.ln(110)
+            self.pdf.multi_cell(0, 10, txt=txt, align='C')
+            span.add(pages=self.pdf.page - first_page)
 
     def add_paragraph(self, txt):
         self.pdf.set_font('dejavu', size=12)
@@ -72,4 +386,14 @@ class WufooPDF(object):
     def add_spacing(self, height=10):
         self.pdf.cell(0, height, ln=1)
 
-
+@contextlib.contextmanager
+def streaming_pdf(out):
+    """Yields a WufooPDF whose pages are written as soon as they're laid out
+    (or appended), so memory use doesn't grow with the number of pages. The
+    PDF appears at `out` once the block finishes (see
+    `checkpoint.atomic_output`)."""
+    with checkpoint.atomic_output(out) as temp_out:
+        with open(temp_out, 'wb') as f:
+            pdf = WufooPDF(stream_to=f)
+            yield pdf
+            pdf.finish()